@@ -1,3 +1,38 @@
-from .job_lock import add_job_lock_arguments, clean_up_old_job_locks, clear_running_jobs_cache, jobfinished, jobinfo, JobLock, JobLockAndWait, MultiJobLock, process_job_lock_arguments, setsqueueoutput
-from .slurm_tmpdir import slurm_clean_up_temp_dir, slurm_rsync_input, slurm_rsync_output
-__all__ = "add_job_lock_arguments", "clean_up_old_job_locks", "clear_running_jobs_cache", "jobfinished", "jobinfo", "JobLock", "JobLockAndWait", "MultiJobLock", "process_job_lock_arguments", "setsqueueoutput", "slurm_clean_up_temp_dir", "slurm_rsync_input", "slurm_rsync_output"
+import importlib, sys
+
+#the submodules are imported the first time one of their names is used,
+#so that `import job_lock` is fast for scripts that only need a JobLock
+_submodules = {
+  "completion_manifest": ("CompletionManifest",),
+  "executor": ("JobLockExecutor", "Skipped"),
+  "inventory": ("lock_inventory",),
+  "job_list_publisher": ("publish_job_list",),
+  "job_lock": ("add_job_lock_arguments", "clean_up_old_job_locks", "clear_running_jobs_cache", "jobfinished", "jobinfo", "jobsfinished", "JobLock", "JobLockAndWait", "JobLockProbe", "MultiJobLock", "process_job_lock_arguments", "setsqueueoutput"),
+  "lock_namespace": ("LockNamespace",),
+  "preemption": ("install_preemption_handler", "release_all_job_locks", "uninstall_preemption_handler"),
+  "reaper": ("reap_stale_locks", "run_reaper"),
+  "semaphore": ("JobSemaphore", "JobSemaphoreAndWait"),
+  "shared_result": ("single_flight",),
+  "slurm_tmpdir": ("slurm_clean_up_temp_dir", "slurm_flush_outputs", "slurm_locality_job_lock", "slurm_open_input", "slurm_rank_by_locality", "slurm_rsync_input", "slurm_rsync_output"),
+  "task_claims": ("TaskClaims",),
+  "trace": ("analyze_traces", "disable_tracing", "enable_tracing", "LockTracer", "read_traces"),
+}
+_namesubmodules = {name: submodule for submodule, names in _submodules.items() for name in names}
+
+__all__ = "add_job_lock_arguments", "analyze_traces", "clean_up_old_job_locks", "clear_running_jobs_cache", "CompletionManifest", "disable_tracing", "enable_tracing", "install_preemption_handler", "jobfinished", "jobinfo", "jobsfinished", "JobLock", "JobLockAndWait", "JobLockExecutor", "JobLockProbe", "JobSemaphore", "JobSemaphoreAndWait", "lock_inventory", "LockNamespace", "LockTracer", "MultiJobLock", "process_job_lock_arguments", "publish_job_list", "read_traces", "reap_stale_locks", "release_all_job_locks", "run_reaper", "setsqueueoutput", "single_flight", "Skipped", "slurm_clean_up_temp_dir", "slurm_flush_outputs", "slurm_locality_job_lock", "slurm_open_input", "slurm_rank_by_locality", "slurm_rsync_input", "slurm_rsync_output", "TaskClaims", "uninstall_preemption_handler"
+
+def __getattr__(name):
+  try:
+    submodule = _namesubmodules[name]
+  except KeyError:
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+  value = getattr(importlib.import_module(f".{submodule}", __name__), name)
+  globals()[name] = value
+  return value
+
+def __dir__():
+  return sorted(set(globals()) | set(__all__))
+
+if sys.version_info < (3, 7):
+  #module __getattr__ doesn't exist yet, so import everything now
+  for _ in __all__: __getattr__(_)
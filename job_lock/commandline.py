@@ -0,0 +1,85 @@
+import argparse, collections, datetime, json, pathlib
+from .inventory import CORRUPT, HELD, lock_inventory, ORPHANED, STALE
+from .job_list_publisher import publish_job_list
+from .job_lock import add_job_lock_arguments, process_job_lock_arguments
+from .reaper import run_reaper
+from .trace import analyze_traces, print_trace_report, read_traces
+
+statuses = HELD, STALE, CORRUPT, ORPHANED
+
+def status(*folders, only=None, json_output=False, glob=None, maxworkers=None):
+  if only is None: only = statuses
+  inventory = [_ for _ in lock_inventory(*folders, glob=glob, maxworkers=maxworkers) if _.status in only]
+  summary = collections.Counter(_.status for _ in inventory)
+  if json_output:
+    print(json.dumps({"locks": [_.todict() for _ in inventory], "summary": {_: summary[_] for _ in only}}, indent=2))
+    return
+  for lock in inventory:
+    age = datetime.timedelta(seconds=round(lock.age.total_seconds()))
+    job = "" if lock.jobtype is None else f"{lock.jobtype} {lock.cpuid} {lock.jobid}"
+    print(f"{lock.status:8} {str(age):>16} {job:24} {lock.filename}")
+  print(", ".join(f"{summary[_]} {_}" for _ in only))
+
+def status_argparse(args):
+  process_job_lock_arguments(args)
+  return status(*args.folders, only=args.only, json_output=args.json, glob=args.glob, maxworkers=args.maxworkers)
+
+def reap_argparse(args):
+  #if the job list output is given explicitly, use it instead of listing the jobs
+  snapshot = all(args.__dict__[_] is None for _ in ("squeue_output", "squeue_output_file", "watch_squeue_output_file", "condorq_output", "condorq_output_file", "watch_condorq_output_file"))
+  process_job_lock_arguments(args)
+  return run_reaper(*args.folders, interval=args.interval, dryrun=args.dryrun, silent=args.silent, snapshot=snapshot, glob=args.glob, maxworkers=args.maxworkers)
+
+def publish_job_list_argparse(args):
+  return publish_job_list(args.filename, args.jobtype, interval=args.interval)
+
+def trace_report(*paths, top=20, timelinebin=60, timeline=False, json_output=False):
+  analysis = analyze_traces(read_traces(*paths), timelinebin=timelinebin)
+  if json_output:
+    print(json.dumps(analysis, indent=2))
+  else:
+    print_trace_report(analysis, top=top, timeline=timeline)
+
+def trace_report_argparse(args):
+  return trace_report(*args.paths, top=args.top, timelinebin=args.timelinebin, timeline=args.timeline, json_output=args.json)
+
+def main(args=None):
+  p = argparse.ArgumentParser(prog="job_lock")
+  subparsers = p.add_subparsers(dest="command", metavar="command")
+  subparsers.required = True
+
+  s = subparsers.add_parser("status", help="list the lock files under some folders and whether the jobs holding them are still running")
+  s.add_argument("folders", type=pathlib.Path, nargs="+", metavar="folder")
+  s.add_argument("--only", action="append", choices=statuses, help="only list locks with this status (can be given more than once)")
+  s.add_argument("--json", action="store_true", help="print the results as json")
+  s.add_argument("--glob", help="look at the files that match this glob (default: *.lock and *.lock_N)")
+  s.add_argument("--max-workers", type=int, dest="maxworkers", help="number of threads to use to scan the folders")
+  add_job_lock_arguments(s)
+  s.set_defaults(function=status_argparse)
+
+  s = subparsers.add_parser("reap", help="remove locks (and their outputs) left behind by jobs that finished")
+  s.add_argument("folders", type=pathlib.Path, nargs="+", metavar="folder")
+  s.add_argument("--interval", type=float, help="keep running, looking for stale locks every this many seconds")
+  s.add_argument("--dry-run", dest="dryrun", action="store_true")
+  s.add_argument("--silent", action="store_true")
+  s.add_argument("--glob", help="look at the files that match this glob (default: *.lock and *.lock_N)")
+  s.add_argument("--max-workers", type=int, dest="maxworkers", help="number of threads to use to scan the folders")
+  add_job_lock_arguments(s)
+  s.set_defaults(function=reap_argparse)
+
+  s = subparsers.add_parser("publish-job-list", help="keep writing the list of all jobs to a file that jobs can share with --watch-squeue-output-file or --watch-condorq-output-file")
+  s.add_argument("filename", type=pathlib.Path)
+  s.add_argument("--batch-system", dest="jobtype", choices=("SLURM", "CONDOR"), default="SLURM")
+  s.add_argument("--interval", type=float, help="update the file every this many seconds (default: only once)")
+  s.set_defaults(function=publish_job_list_argparse)
+
+  s = subparsers.add_parser("trace-report", help="summarize lock traces written with --job-lock-trace-dir or enable_tracing()")
+  s.add_argument("paths", type=pathlib.Path, nargs="+", metavar="path", help="trace files or folders containing them")
+  s.add_argument("--top", type=int, default=20, help="number of locks to list")
+  s.add_argument("--timeline", action="store_true", help="also print a timeline")
+  s.add_argument("--timeline-bin", type=float, default=60, dest="timelinebin", help="seconds per line of the timeline")
+  s.add_argument("--json", action="store_true", help="print the results as json")
+  s.set_defaults(function=trace_report_argparse)
+
+  args = p.parse_args(args=args)
+  return args.function(args)
@@ -0,0 +1,114 @@
+import os, pathlib
+from .job_lock import JobLock, rm_missing_ok
+
+class CompletionManifest(object):
+  """
+  Append-only record of the output files written by successful JobLocks
+  in a pipeline directory.  Pass it to JobLock as completionmanifest=...
+  and outputs that are in the manifest are considered to exist without
+  being stat'ed.  Outputs that aren't in the manifest are still stat'ed.
+
+  The manifest is read once per CompletionManifest object.  If it can't
+  be fully parsed, every output is stat'ed as usual.  If verify=True,
+  every output is stat'ed, and one whose size or modification time
+  doesn't match the manifest (e.g. because it was truncated or rewritten
+  after it was recorded) is considered missing.
+  """
+  defaultfilename = ".job_lock_manifest"
+
+  def __init__(self, folder, *, verify=False, filename=None):
+    if filename is None: filename = self.defaultfilename
+    self.filename = pathlib.Path(folder)/filename
+    self.verify = verify
+    self.__entries = None
+    self.__suspect = False
+
+  def load(self):
+    entries = {}
+    suspect = False
+    try:
+      with open(self.filename) as f:
+        for line in f:
+          if not line.endswith("\n"):
+            #partially written
+            suspect = True
+            continue
+          try:
+            size, mtime, path = line[:-1].split(" ", 2)
+            entries[path] = int(size), int(mtime)
+          except ValueError:
+            suspect = True
+    except FileNotFoundError:
+      pass
+    self.__entries = entries
+    self.__suspect = suspect
+
+  @property
+  def entries(self):
+    if self.__entries is None: self.load()
+    return self.__entries
+
+  @property
+  def suspect(self):
+    if self.__entries is None: self.load()
+    return self.__suspect
+
+  def outputexists(self, outputfile):
+    entry = self.entries.get(os.path.abspath(outputfile))
+    if not self.verify and not self.suspect and entry is not None:
+      return True
+    try:
+      stat = os.stat(outputfile)
+    except (FileNotFoundError, NotADirectoryError):
+      return False
+    if self.verify and entry is not None and entry != (stat.st_size, stat.st_mtime_ns):
+      return False
+    return True
+
+  def outputsexist(self, outputfiles):
+    return {_: self.outputexists(_) for _ in outputfiles}
+
+  def record(self, outputfiles):
+    lines = []
+    for outputfile in outputfiles:
+      path = os.path.abspath(outputfile)
+      if "\n" in path: continue
+      try:
+        stat = os.stat(path)
+      except FileNotFoundError:
+        continue
+      lines.append(f"{stat.st_size} {stat.st_mtime_ns} {path}\n")
+      if self.__entries is not None:
+        self.__entries[path] = stat.st_size, stat.st_mtime_ns
+    if not lines: return
+    #a single write with O_APPEND, so that records from different jobs don't get mixed up
+    fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+    try:
+      os.write(fd, "".join(lines).encode())
+    finally:
+      os.close(fd)
+
+  def compact(self, *, removemissing=True):
+    """
+    Rewrite the manifest with one line per output, optionally dropping
+    outputs that no longer exist.  Records appended by other jobs while
+    this is running can be lost, so only run it when the pipeline is idle.
+    Returns False if another job is already compacting the manifest.
+    """
+    with JobLock(self.filename.with_name(self.filename.name + ".compact.lock")) as lock:
+      if not lock: return False
+      self.load()
+      entries = self.entries
+      if removemissing:
+        entries = {path: entry for path, entry in entries.items() if os.path.exists(path)}
+      tmpfilename = self.filename.with_name(f"{self.filename.name}.{os.getpid()}")
+      try:
+        with open(tmpfilename, "w") as f:
+          for path, (size, mtime) in sorted(entries.items()):
+            f.write(f"{size} {mtime} {path}\n")
+        os.replace(tmpfilename, self.filename)
+      finally:
+        rm_missing_ok(tmpfilename)
+      self.__entries = entries
+      self.__suspect = False
+    return True
@@ -0,0 +1,149 @@
+import collections, concurrent.futures, functools, os, threading
+from .job_lock import JobLock
+
+class Skipped(object):
+  """
+  Result of a JobLockExecutor task that wasn't run, because its outputs
+  already exist, another job holds its lock, or its inputs are missing.
+  reason is the JobLock's outcome: "outputsexist", "held", etc.
+  """
+  def __init__(self, reason):
+    self.reason = reason
+  def __repr__(self):
+    return f"{type(self).__name__}({self.reason!r})"
+  def __bool__(self):
+    return False
+
+class JobLockExecutor(object):
+  """
+  Runs functions in a pool of processes (or threads, if usethreads=True),
+  each one under its own JobLock:
+
+    with JobLockExecutor() as executor:
+      futures = [executor.submit(lockfilename, function, *args, outputfiles=[...], **kwargs) for ...]
+
+  The locks are taken and released in this process, and only for the tasks
+  that are about to run, so the workers never touch the lock files and other
+  jobs can still take the tasks that haven't started yet.  Up to maxinflight
+  tasks (by default twice the number of workers) hold their locks at once, so
+  that there's always another task ready when a worker finishes.
+
+  A task whose lock can't be acquired isn't run, and its result is a Skipped
+  object.  If a task raises an exception, its output files are removed as
+  usual for JobLock.  lockkwargs are passed to every JobLock.
+
+  It works like a concurrent.futures.Executor, but it isn't one, because
+  submit needs the lock filename, so there's no map.
+  """
+  def __init__(self, maxworkers=None, *, usethreads=False, maxinflight=None, **lockkwargs):
+    if maxworkers is None:
+      maxworkers = os.cpu_count() or 1
+    if usethreads:
+      self.__pool = concurrent.futures.ThreadPoolExecutor(max_workers=maxworkers)
+    else:
+      self.__pool = concurrent.futures.ProcessPoolExecutor(max_workers=maxworkers)
+    if maxinflight is None:
+      maxinflight = 2 * maxworkers
+    self.maxinflight = maxinflight
+    self.__lockkwargs = lockkwargs
+    self.__pending = collections.deque()
+    self.__finished = collections.deque()
+    self.__ninflight = 0
+    self.__shutdown = False
+    self.__condition = threading.Condition()
+    #the locks are acquired and released in this thread, so that the lock
+    #files (and maybe the job list command) don't hold up the pool's threads
+    self.__dispatcher = threading.Thread(target=self.__dispatch, daemon=True)
+    self.__dispatcher.start()
+
+  def submit(self, lockfilename, fn, *args, outputfiles=[], inputfiles=[], **kwargs):
+    future = concurrent.futures.Future()
+    with self.__condition:
+      if self.__shutdown: raise RuntimeError("cannot schedule new futures after shutdown")
+      self.__pending.append((future, lockfilename, fn, args, kwargs, outputfiles, inputfiles))
+      self.__condition.notify()
+    return future
+
+  def __hasworktodo(self):
+    if self.__finished: return True
+    if self.__pending: return self.__ninflight < self.maxinflight
+    return self.__shutdown and not self.__ninflight
+
+  def __dispatch(self):
+    while True:
+      with self.__condition:
+        self.__condition.wait_for(self.__hasworktodo)
+        if self.__finished:
+          task = None
+          finished = self.__finished.popleft()
+        elif self.__pending:
+          task = self.__pending.popleft()
+          self.__ninflight += 1
+        else:
+          break
+      if task is None:
+        self.__release(*finished)
+      else:
+        self.__start(*task)
+    self.__pool.shutdown(wait=False)
+
+  def __done(self):
+    with self.__condition:
+      self.__ninflight -= 1
+
+  def __start(self, future, lockfilename, fn, args, kwargs, outputfiles, inputfiles):
+    try:
+      if not future.set_running_or_notify_cancel(): #cancelled
+        self.__done()
+        return
+      lock = JobLock(lockfilename, outputfiles=outputfiles, inputfiles=inputfiles, **self.__lockkwargs)
+      lock.__enter__()
+      if not lock:
+        self.__done()
+        future.set_result(Skipped(lock.outcome))
+        return
+      try:
+        inner = self.__pool.submit(fn, *args, **kwargs)
+      except BaseException as e:
+        lock.__exit__(type(e), e, e.__traceback__)
+        raise
+    except BaseException as e:
+      self.__done()
+      if not future.done(): future.set_exception(e)
+      return
+    inner.add_done_callback(functools.partial(self.__innerdone, future, lock))
+
+  def __innerdone(self, future, lock, inner):
+    #called in one of the pool's threads, so leave the work to the dispatcher
+    with self.__condition:
+      self.__finished.append((future, lock, inner))
+      self.__condition.notify()
+
+  def __release(self, future, lock, inner):
+    exc = inner.exception()
+    try:
+      if exc is None:
+        lock.__exit__(None, None, None)
+      else:
+        lock.__exit__(type(exc), exc, exc.__traceback__)
+    except BaseException as e:
+      if exc is None: exc = e
+    finally:
+      self.__done()
+    if exc is None:
+      future.set_result(inner.result())
+    else:
+      future.set_exception(exc)
+
+  def __enter__(self):
+    return self
+  def __exit__(self, exc_type, exc, traceback):
+    self.shutdown(wait=True)
+
+  def shutdown(self, wait=True):
+    with self.__condition:
+      self.__shutdown = True
+      self.__condition.notify()
+    if wait:
+      self.__dispatcher.join()
+      self.__pool.shutdown(wait=True)
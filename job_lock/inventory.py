@@ -0,0 +1,78 @@
+import collections, concurrent.futures, datetime, pathlib, re
+from .job_lock import _rglob, JobLockProbe
+
+HELD = "held"
+STALE = "stale"
+CORRUPT = "corrupt"
+ORPHANED = "orphaned"
+
+_LockStatus = collections.namedtuple("_LockStatus", ["filename", "status", "jobtype", "cpuid", "jobid", "age", "reclaimable"])
+
+class LockStatus(_LockStatus):
+  """
+  status is one of
+    held:     the job that holds the lock is still running (or we can't tell)
+    stale:    the job that holds the lock is finished
+    corrupt:  the lock file couldn't be parsed
+    orphaned: an iterative lock (.lock_N) whose main lock doesn't exist
+  reclaimable says whether a JobLock on this file would remove it.
+  """
+  def todict(self):
+    result = self._asdict()
+    result["filename"] = str(self.filename)
+    result["age"] = None if self.age is None else self.age.total_seconds()
+    return result
+
+def _iterationof(filename):
+  """
+  The main lock that filename is an iteration of, or None if it isn't an iterative lock.
+  """
+  match = re.match("[.]lock_([0-9]+)$", filename.suffix)
+  if not match or int(match.group(1)) < 2: return None
+  return filename.with_suffix(".lock")
+
+def lock_inventory(*folders, glob=None, maxworkers=None, **probekwargs):
+  """
+  Find all the lock files under folders and figure out which are held,
+  stale, corrupt, or orphaned.  The folders are scanned and the lock files
+  are read in parallel, and the jobs holding them are checked with one job
+  list command per batch system.
+
+  The lock files are the .lock and .lock_N files, or, if glob is given,
+  all the files that match it, as for clean_up_old_job_locks.
+
+  probekwargs (timeout, corruptfiletimeout, minimumtimeforiterativelocks,
+  dosqueue, cachesqueue) are passed to JobLockProbe.
+  """
+  probe = JobLockProbe(**probekwargs)
+  with concurrent.futures.ThreadPoolExecutor(max_workers=maxworkers) as executor:
+    filenames = []
+    for folder in folders:
+      if glob is None:
+        filenames += [_ for _ in _rglob(pathlib.Path(folder), "*.lock*", executor=executor) if re.match("[.]lock(?:_[0-9]+)?$", _.suffix)]
+      else:
+        filenames += _rglob(pathlib.Path(folder), glob, executor=executor)
+    records = dict(zip(filenames, executor.map(JobLockProbe.readlockfile, filenames, chunksize=100)))
+
+  #removed while we were scanning
+  records = {filename: record for filename, record in records.items() if record is not None}
+  statuses = probe.statusesfromrecords(records)
+
+  result = []
+  now = datetime.datetime.now()
+  for filename, (modified, info, starttime) in sorted(records.items()):
+    jobtype = cpuid = jobid = None
+    if not isinstance(info, Exception):
+      jobtype, cpuid, jobid = info
+    reclaimable = statuses[filename] == JobLockProbe.STALE
+    mainlock = _iterationof(filename)
+    if mainlock is not None and mainlock not in records:
+      status = ORPHANED
+    elif isinstance(info, ValueError):
+      status = CORRUPT
+    elif reclaimable:
+      status = STALE
+    else:
+      status = HELD
+    result.append(LockStatus(filename=filename, status=status, jobtype=jobtype, cpuid=cpuid, jobid=jobid, age=now-modified, reclaimable=reclaimable))
+  return result
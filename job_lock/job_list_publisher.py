@@ -0,0 +1,31 @@
+import itertools, os, pathlib, time
+from .job_lock import batchsubmissionsystems, logger, rm_missing_ok
+
+def publish_job_list(filename, jobtype="SLURM", *, interval=None, cycles=None):
+  """
+  Write the list of all the jobs in the batch system to filename every
+  interval seconds (once if interval is None), for cycles cycles or forever,
+  so that jobs can read it with setsqueueoutput(filename=..., watch=True)
+  (or setcondorqoutput) instead of each running squeue (or condor_q).
+
+  The file is replaced in one step, so nobody reads a partial list.  If the
+  job list command fails, the file is left alone, so that its age shows
+  that it's out of date.
+  """
+  system, = (_ for _ in batchsubmissionsystems if _.jobtype() == jobtype)
+  filename = pathlib.Path(filename)
+  tmpfilename = filename.with_name(f".{filename.name}.{os.getpid()}")
+  for cycle in itertools.count(1):
+    start = time.monotonic()
+    output = system.alljobsoutput()
+    if output is None:
+      logger.warning(f"Couldn't list the {jobtype} jobs, not updating {filename}")
+    else:
+      try:
+        with open(tmpfilename, "wb") as f:
+          f.write(output)
+        os.replace(tmpfilename, filename)
+      finally:
+        rm_missing_ok(tmpfilename)
+    if interval is None or cycles is not None and cycle >= cycles: return
+    time.sleep(max(interval - (time.monotonic() - start), 0))
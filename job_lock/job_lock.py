@@ -1,6 +1,6 @@
-import abc, argparse, contextlib, datetime, itertools, logging, os, pathlib, random, re, socket, subprocess, sys, time, uuid
-if sys.platform != "cygwin":
-  import psutil
+import abc, collections, contextlib, datetime, fnmatch, functools, io, itertools, logging, os, pathlib, random, re, subprocess, sys, threading, time
+#psutil, uuid, socket, argparse and concurrent.futures are imported where they're
+#used, because they're slow to import and not needed for every lock
 
 logger = logging.getLogger("JobLock")
 logger.setLevel(logging.INFO)
@@ -14,7 +14,9 @@ def rm_missing_ok(path):
     except FileNotFoundError:
       pass
 
+@functools.lru_cache(maxsize=None)
 def cpuid():
+  import uuid
   node = uuid.getnode()
   #least significant bit of the first octet is not set --> this is a hardware address
   if not node & 2**40:
@@ -48,11 +50,86 @@ def cpuid():
 
   raise ValueError("Couldn't find a cpuid using any of the methods we know about")
 
+@functools.lru_cache(maxsize=None)
+def _hostname():
+  import socket
+  return socket.gethostname()
+
+def _psutil():
+  import psutil
+  return psutil
+
+def processstarttime(pid):
+  if sys.platform == "cygwin": return None
+  psutil = _psutil()
+  try:
+    return psutil.Process(pid).create_time()
+  except psutil.NoSuchProcess:
+    return None
+
+def processrunning(pid, starttime=None):
+  if sys.platform == "cygwin":
+    try:
+      os.kill(pid, 0)
+    except ProcessLookupError:
+      return False
+    except PermissionError:
+      pass #the process exists but belongs to someone else
+    return True
+
+  psutil = _psutil()
+  try:
+    process = psutil.Process(pid)
+  except psutil.NoSuchProcess:
+    return False
+  if starttime is None: return True
+  try:
+    #if the start time doesn't match, the pid was reused by a different process
+    return abs(process.create_time() - starttime) < 1
+  except psutil.NoSuchProcess:
+    return False
+
+class JobListSnapshot(object):
+  """
+  Running and pending jobs from the output of a job list command,
+  indexed so that looking up a job doesn't depend on how many jobs are listed.
+  """
+  def __init__(self, jobs):
+    self.__running = {}
+    self.__pending = {}
+    self.maxseenjob = -float("inf"), -float("inf")
+    for (cpuid, jobid), pending in jobs:
+      (self.__pending if pending else self.__running).setdefault(cpuid, set()).add(jobid)
+      if (cpuid, jobid) > self.maxseenjob:
+        self.maxseenjob = cpuid, jobid
+
+  def isrunning(self, cpuid, jobid):
+    return jobid in self.__running.get(cpuid, ())
+  def ispending(self, cpuid, jobid):
+    return jobid in self.__pending.get(cpuid, ())
+
+  def runningjobs(self):
+    for cpuid, jobids in self.__running.items():
+      for jobid in jobids:
+        yield cpuid, jobid
+
+#set as the job list snapshot when the job list output that was given can't be parsed
+_invalidjoblistoutput = object()
+
 class BatchSubmissionSystem(abc.ABC):
+  defaultjoblisttimeout = datetime.timedelta(minutes=1)
+  defaultjoblistinitialbackoff = datetime.timedelta(seconds=30)
+  defaultjoblistmaxbackoff = datetime.timedelta(minutes=30)
+  #a watched job list output that's older than this is ignored
+  defaultjoblistoutputmaxage = datetime.timedelta(minutes=10)
+  #above this many jobs, list all jobs instead of passing them on the command line
+  maxjobsperjoblistcommand = 1000
+
   def __init__(self):
     self.__knownrunningjobs = set()
-    self.__joblistoutput = None
-    self.__joblisterror = False
+    self.__joblistsnapshot = None
+    self.__watchedfile = self.__watchedfilekey = None
+    self.__resetcircuitbreaker()
 
   class WrongBatchSystemError(Exception): pass
   class JobListCommandError(Exception): pass
@@ -61,96 +138,245 @@ class BatchSubmissionSystem(abc.ABC):
   @abc.abstractmethod
   def jobinfo(self): pass
   @abc.abstractmethod
-  def joblistcommand(self, cpuid, jobid): pass
+  def joblistcommand(self, jobs):
+    """
+    Command to list the (cpuid, jobid) jobs, or all jobs if jobs is None.
+    """
   @abc.abstractmethod
   def jobtype(self): pass
   @abc.abstractmethod
-  def runningjobsfromoutput(self, output): pass
+  def jobfromjoblistline(self, line): pass
   @abc.abstractmethod
   def processjoblistcommanderror(self, calledprocesserror): pass
 
   def clearrunningjobscache(self):
     self.__knownrunningjobs.clear()
-    self.__joblisterror = False
+    self.__resetcircuitbreaker()
+
+  def __resetcircuitbreaker(self):
+    self.__joblistfailures = 0
+    self.__joblistretrytime = None
+
+  def __joblistfailed(self):
+    #stop running the job list command for a while, backing off exponentially
+    #if it keeps failing when we try again
+    self.__joblistfailures += 1
+    backoff = self.defaultjoblistinitialbackoff * 2**(self.__joblistfailures-1)
+    if self.defaultjoblistmaxbackoff is not None:
+      backoff = min(backoff, self.defaultjoblistmaxbackoff)
+    self.__joblistretrytime = time.monotonic() + backoff.total_seconds()
+    logger.debug("Not running the job list command again for %s", backoff)
 
-  def setjoblistoutput(self, *, output=None, filename=None):
+  @property
+  def joblistcircuitopen(self):
+    if self.__joblistretrytime is None: return False
+    return time.monotonic() < self.__joblistretrytime
+
+  def snapshotfromoutput(self, lines):
+    """
+    Parse the job list output one line at a time.
+    Each line is parsed by jobfromjoblistline, which returns
+    ((cpuid, jobid), ispending), or None for lines that don't describe a job.
+    """
+    return JobListSnapshot(job for job in (self.jobfromjoblistline(line) for line in lines) if job is not None)
+
+  def alljobsoutput(self):
+    """
+    Run the job list command for all jobs and return its output,
+    which can be passed to setjoblistoutput, or None if it fails.
+    """
+    timeout = self.defaultjoblisttimeout
+    if timeout is not None: timeout = timeout.total_seconds()
+    try:
+      return subprocess.check_output(self.joblistcommand(None), stderr=subprocess.DEVNULL, timeout=timeout)
+    except (FileNotFoundError, subprocess.TimeoutExpired, subprocess.CalledProcessError):
+      logger.debug("Couldn't list all jobs")
+      return None
+
+  def setjoblistoutput(self, *, output=None, filename=None, watch=False, maxage=None):
+    """
+    Use this job list output, or the contents of filename, instead of
+    running the job list command.  Jobs submitted after the output was
+    made are never considered finished.
+
+    If watch is True, filename is read again whenever it changes, so that
+    a job list written every few minutes by publish_job_list can be shared
+    by all the jobs.  If it hasn't been updated for longer than maxage
+    (a timedelta, by default defaultjoblistoutputmaxage), e.g. because the
+    publisher died, it's ignored, as if no output had been set, until it is.
+    """
     if filename is not None and output is not None:
       raise TypeError("Provided both output and filename")
-    elif filename is not None:
-      with open(filename, "rb") as f:
-        self.setjoblistoutput(output=f.read())
-    else:
-      self.__joblistoutput = output
+    if watch and filename is None:
+      raise TypeError("Need a filename to watch")
+    self.__watchedfile = self.__watchedfilekey = None
+    if watch:
+      self.__joblistsnapshot = None
+      if maxage is None: maxage = self.defaultjoblistoutputmaxage
+      self.__watchedfile = pathlib.Path(filename), maxage
+      return
+    try:
+      if filename is not None:
+        with open(filename, "rb") as f:
+          self.__joblistsnapshot = self.snapshotfromoutput(f)
+      elif output is not None:
+        if isinstance(output, str): output = output.encode("ascii")
+        self.__joblistsnapshot = self.snapshotfromoutput(io.BytesIO(output))
+      else:
+        self.__joblistsnapshot = None
+    except self.InvalidJobListOutputError:
+      logger.debug("Job list output is invalid")
+      self.__joblistsnapshot = _invalidjoblistoutput
+
+  @contextlib.contextmanager
+  def temporaryjoblistoutput(self, **kwargs):
+    """
+    setjoblistoutput(**kwargs) inside the with block,
+    and go back to whatever was set before afterwards.
+    """
+    saved = self.__joblistsnapshot, self.__watchedfile, self.__watchedfilekey
+    try:
+      self.setjoblistoutput(**kwargs)
+      yield
+    finally:
+      self.__joblistsnapshot, self.__watchedfile, self.__watchedfilekey = saved
+
+  def __currentjoblistsnapshot(self):
+    if self.__watchedfile is None: return self.__joblistsnapshot
+    filename, maxage = self.__watchedfile
+    try:
+      stat = filename.stat()
+    except FileNotFoundError:
+      logger.debug("Job list output %s doesn't exist", filename)
+      return None
+    if time.time() - stat.st_mtime > maxage.total_seconds():
+      logger.debug("Job list output %s is out of date", filename)
+      return None
+    #the file is replaced, not rewritten, so the inode changes too
+    key = stat.st_mtime_ns, stat.st_size, stat.st_ino
+    if key != self.__watchedfilekey:
+      logger.debug("Reading job list output from %s", filename)
+      try:
+        with open(filename, "rb") as f:
+          self.__joblistsnapshot = self.snapshotfromoutput(f)
+      except FileNotFoundError:
+        return None
+      except self.InvalidJobListOutputError:
+        logger.debug("Job list output is invalid")
+        self.__joblistsnapshot = _invalidjoblistoutput
+      self.__watchedfilekey = key
+    return self.__joblistsnapshot
+
+  @classmethod
+  def setdefaultjoblisttimeout(cls, timeout):
+    cls.defaultjoblisttimeout = timeout
+  @classmethod
+  def setdefaultjoblistbackoff(cls, initial, maximum):
+    cls.defaultjoblistinitialbackoff = initial
+    cls.defaultjoblistmaxbackoff = maximum
 
   def jobfinished(self, jobtype, cpuid, jobid, *, dojoblist=True, cachejoblist=True):
+    return self.jobsfinished(jobtype, [(cpuid, jobid)], dojoblist=dojoblist, cachejoblist=cachejoblist)[cpuid, jobid]
+
+  def jobsfinished(self, jobtype, jobs, *, dojoblist=True, cachejoblist=True):
+    """
+    Determine whether each of the (cpuid, jobid) jobs is finished,
+    running the job list command at most once for all of them.
+    Returns a dict {(cpuid, jobid): True, False, or None (don't know)}.
+    """
     if jobtype != self.jobtype():
       raise self.WrongBatchSystemError()
-    logger.debug("Determining if job %s %s %s is finished", jobtype, cpuid, jobid)
-    if self.__joblisterror: dojoblist = False
-    joblistoutput = self.__joblistoutput
-
-    if cachejoblist and (cpuid, jobid) in self.__knownrunningjobs:
-      logger.debug("Job is already known to be running")
-      return False #assume job is still running
-    if not dojoblist and joblistoutput is None:
+    jobs = set(jobs)
+    logger.debug("Determining if jobs %s %s are finished", jobtype, sorted(jobs))
+    if self.joblistcircuitopen: dojoblist = False
+    joblistsnapshot = self.__currentjoblistsnapshot()
+
+    results = {}
+    if cachejoblist:
+      for job in jobs & self.__knownrunningjobs:
+        logger.debug("Job %s is already known to be running", job)
+        results[job] = False #assume job is still running
+      jobs -= self.__knownrunningjobs
+    if not jobs:
+      return results
+    if not dojoblist and joblistsnapshot is None:
       logger.debug("Can't tell, because dojoblist is False and no output has been set")
-      return None #don't know if the job finished
+      results.update(dict.fromkeys(jobs, None)) #don't know if the jobs finished
+      return results
 
-    if joblistoutput is not None:
+    if joblistsnapshot is not None:
       logger.debug("Using previously given job list output")
-      output = joblistoutput
+      if joblistsnapshot is _invalidjoblistoutput:
+        results.update(dict.fromkeys(jobs, None)) #don't know if the jobs finished
+        return results
+      snapshot = joblistsnapshot
       freshjoblist = False
     else:
+      timeout = self.defaultjoblisttimeout
+      if timeout is not None: timeout = timeout.total_seconds()
       try:
-        output = subprocess.check_output(self.joblistcommand(cpuid, jobid), stderr=subprocess.STDOUT)
+        command = self.joblistcommand(sorted(jobs) if len(jobs) <= self.maxjobsperjoblistcommand else None)
+        output = subprocess.check_output(command, stderr=subprocess.STDOUT, timeout=timeout)
       except FileNotFoundError: #command doesn't exist on the batch machines
         logger.debug("Job list command doesn't exist")
-        return None #we don't know if the job finished
+        results.update(dict.fromkeys(jobs, None)) #we don't know if the jobs finished
+        return results
+      except subprocess.TimeoutExpired:
+        logger.debug("Job list command timed out")
+        self.__joblistfailed()
+        results.update(dict.fromkeys(jobs, None)) #we don't know if the jobs finished
+        return results
       except subprocess.CalledProcessError as e:
         try:
-          return self.processjoblistcommanderror(e)
+          result = self.processjoblistcommanderror(e)
         except self.JobListCommandError:
           logger.debug("Job list command gave an error")
-          self.__joblisterror = True
-          return None #we don't know if the job finished
+          self.__joblistfailed()
+          results.update(dict.fromkeys(jobs, None)) #we don't know if the jobs finished
+          return results
         except subprocess.CalledProcessError:
           print(e.output.decode("ascii"), end="")
           raise
+        self.__resetcircuitbreaker()
+        if len(jobs) > 1:
+          #the error might only apply to some of the jobs, so check them individually
+          for job in jobs:
+            results.update(self.jobsfinished(jobtype, [job], dojoblist=dojoblist, cachejoblist=cachejoblist))
+          return results
+        results.update(dict.fromkeys(jobs, result))
+        return results
+      self.__resetcircuitbreaker()
+
+      try:
+        snapshot = self.snapshotfromoutput(io.BytesIO(output))
+      except self.InvalidJobListOutputError:
+        logger.debug("Job list command gave invalid output")
+        results.update(dict.fromkeys(jobs, None)) #don't know if the jobs finished, probably a temporary glitch
+        return results
       freshjoblist = True
+      self.__knownrunningjobs.update(snapshot.runningjobs())
 
-    try:
-      runningjobs, pendingjobs = self.runningjobsfromoutput(output)
-    except self.InvalidJobListOutputError:
-      logger.debug("Job list command gave invalid output")
-      return None #don't know if the job finished, probably a temporary glitch
-
-    if not freshjoblist:
-      runningjobs += pendingjobs
-      pendingjobs = []
-
-    maxseenjob = -float("inf"), -float("inf")
-    for runningjob in runningjobs + pendingjobs:
-      maxseenjob = max(runningjob, maxseenjob)
-
-    for runningjob in runningjobs:
-      self.__knownrunningjobs.add(runningjob)
-      logger.debug("Job running: %s %s", cpuid, jobid)
-      if runningjob == (cpuid, jobid):
-        logger.debug("Found it!")
-        return False #job is still running
-
-    for pendingjob in pendingjobs:
-      assert freshjoblist
-      logger.debug("Job pending: %s %s", cpuid, jobid)
-      if pendingjob == (cpuid, jobid):
-        logger.debug("Found it!")
-        return True #can happen if the job was cancelled and automatically resubmitted (happens on slurm, don't know about others)
-
-    if not freshjoblist and (cpuid, jobid) > maxseenjob:
-      logger.debug("Job list output was provided manually and the max seen job is %s, so we don't know if %s was submitted later", maxseenjob, (cpuid, jobid))
+    for job in jobs:
+      results[job] = self.jobfinishedfromsnapshot(snapshot, job, freshjoblist=freshjoblist)
+    return results
+
+  @staticmethod
+  def jobfinishedfromsnapshot(snapshot, job, *, freshjoblist):
+    if snapshot.isrunning(*job):
+      logger.debug("Found %s running", job)
+      return False #job is still running
+
+    if snapshot.ispending(*job):
+      logger.debug("Found %s pending", job)
+      if not freshjoblist:
+        return False #the job might have started since the job list output was made
+      return True #can happen if the job was cancelled and automatically resubmitted (happens on slurm, don't know about others)
+
+    if not freshjoblist and job > snapshot.maxseenjob:
+      logger.debug("Job list output was provided manually and the max seen job is %s, so we don't know if %s was submitted later", snapshot.maxseenjob, job)
       return None #don't know if the job was started after the job list command was run
 
-    logger.debug("Didn't find %s, so it must have finished", (cpuid, jobid))
+    logger.debug("Didn't find %s, so it must have finished", job)
     return True #job is finished
 
 class Condor(BatchSubmissionSystem):
@@ -167,27 +393,44 @@ class Condor(BatchSubmissionSystem):
     if jobinfo is not None: return self.jobtype(), jobinfo[0], jobinfo[1]
     raise self.WrongBatchSystemError()
 
-  def joblistcommand(self, cpuid, jobid):
-    return ["condor_q", "-nobatch", "-run"]
+  #https://htcondor.readthedocs.io/en/latest/classad-attributes/job-classad-attributes.html#JobStatus
+  runningstatuses = 2, 6, 7 #running, transferring output, suspended
+  pendingstatuses = 1, 5 #idle, held
+
+  def joblistcommand(self, jobs):
+    if jobs is None:
+      return ["condor_q", "-allusers", "-af", "ClusterId", "ProcId", "JobStatus"]
+    clusterids = sorted({clusterid for clusterid, procid in jobs})
+    constraint = " || ".join(f"ClusterId == {clusterid}" for clusterid in clusterids)
+    return ["condor_q", "-af", "ClusterId", "ProcId", "JobStatus", "-constraint", constraint]
 
   def processjoblistcommanderror(self, calledprocesserror):
     if b"Can't find address for schedd" in calledprocesserror.output:
       raise self.JobListCommandError(calledprocesserror)
     raise calledprocesserror
 
-  def runningjobsfromoutput(self, output):
-    running, pending = [], []
-    for line in output.decode("ascii").split("\n"):
-      line = line.strip()
-      if not line: continue
-      if line.startswith("-- Schedd:"): continue
-      if line.startswith("ID "): continue
-      jobid = line.split()[0]
-      clusterid, procid = jobid.split(".")
-      clusterid = int(clusterid)
-      procid = int(procid)
-      running.append((clusterid, procid))
-    return running, pending
+  def jobfromjoblistline(self, line):
+    line = line.strip()
+    if not line: return None
+    if line.startswith(b"-- Schedd:"): return None
+    if line.startswith(b"ID "): return None
+    fields = line.split()
+    if len(fields) == 3 and b"." not in fields[0]:
+      #condor_q -af ClusterId ProcId JobStatus
+      try:
+        clusterid, procid, status = (int(_) for _ in fields)
+      except ValueError:
+        raise self.InvalidJobListOutputError()
+      if status in self.runningstatuses:
+        return (clusterid, procid), False
+      if status in self.pendingstatuses:
+        return (clusterid, procid), True
+      return None #removed or completed
+    #condor_q -nobatch -run, which only lists running jobs
+    clusterid, procid = fields[0].split(b".")
+    clusterid = int(clusterid)
+    procid = int(procid)
+    return (clusterid, procid), False
 
 class Slurm(BatchSubmissionSystem):
   @staticmethod
@@ -199,8 +442,10 @@ class Slurm(BatchSubmissionSystem):
     if jobid is None: raise self.WrongBatchSystemError()
     return self.jobtype(), 0, jobid
 
-  def joblistcommand(self, cpuid, jobid):
-    return ["squeue", "--job", str(jobid), "--Format", "jobid,state", "--noheader"]
+  def joblistcommand(self, jobs):
+    if jobs is None:
+      return ["squeue", "--Format", "jobid,state", "--noheader"]
+    return ["squeue", "--job", ",".join(str(jobid) for cpuid, jobid in jobs), "--Format", "jobid,state", "--noheader"]
 
   def processjoblistcommanderror(self, calledprocesserror):
     if b"slurm_load_jobs error: Invalid job id specified" in calledprocesserror.output:
@@ -211,22 +456,15 @@ class Slurm(BatchSubmissionSystem):
       raise self.JobListCommandError(calledprocesserror)
     raise calledprocesserror
 
-  def runningjobsfromoutput(self, output):
-    running, pending = [], []
-    for line in output.decode("ascii").split("\n"):
-      line = line.strip()
-      if not line: continue
-      try:
-        jobid, state = line.split()
-      except ValueError:
-        raise self.InvalidJobListOutputError()
+  def jobfromjoblistline(self, line):
+    line = line.strip()
+    if not line: return None
+    try:
+      jobid, state = line.split()
       jobid = int(jobid)
-      if state in ("PENDING", "PD"):
-        pending.append((0, jobid))
-      else:
-        running.append((0, jobid))
-
-    return running, pending
+    except ValueError:
+      raise self.InvalidJobListOutputError()
+    return (0, jobid), state in (b"PENDING", b"PD")
 
 slurm = Slurm()
 condor = Condor()
@@ -243,13 +481,108 @@ def jobinfo():
       pass
   return sys.platform, cpuid(), os.getpid()
 
+_jobheader = None, None
+
+def jobheader():
+  """
+  The first lines of a lock file, which say which job holds it.
+  They're computed again only if jobinfo() changes, e.g. after a fork.
+  """
+  global _jobheader
+  myjobinfo = jobinfo()
+  if _jobheader[0] == myjobinfo: return _jobheader[1]
+  header = " ".join(str(_) for _ in myjobinfo)
+  header += "\n" + _hostname()
+  if myjobinfo[0] == sys.platform:
+    #record the process start time so that a reused pid isn't mistaken for this job
+    starttime = processstarttime(myjobinfo[2])
+    if starttime is not None:
+      header += f"\nstarttime {starttime!r}"
+  _jobheader = myjobinfo, header
+  return header
+
+#JobLocks that are currently held by this process, in the order they were acquired
+_heldjoblocks = {}
+
+def held_job_locks():
+  return list(_heldjoblocks)
+
+#object with an event(event, lockfilename, **fields) method that's told about
+#every lock attempt, release, etc., see trace.py
+tracer = None
+
+def settracer(newtracer):
+  global tracer
+  tracer = newtracer
+
+#lock files that threads in this process hold or are trying to get: {absolute path: thread id}
+#The condition is notified whenever one is removed.  It's reentrant in case
+#release_all_job_locks runs in a signal handler while the main thread is holding it.
+_threadlocks = {}
+_threadlockcondition = threading.Condition(threading.RLock())
+
+def _resetthreadlocks():
+  #after a fork, the threads that held the locks don't exist in the child
+  global _threadlockcondition
+  _threadlocks.clear()
+  _threadlockcondition = threading.Condition(threading.RLock())
+if hasattr(os, "register_at_fork"):
+  os.register_at_fork(after_in_child=_resetthreadlocks)
+
+def _waitforotherthread(filename, timeout):
+  """
+  If another thread in this process holds the lock on filename, wait until it's
+  released or until timeout seconds have passed, and return True.
+  Otherwise return False right away.
+  """
+  key = os.path.abspath(filename)
+  me = threading.get_ident()
+  with _threadlockcondition:
+    if _threadlocks.get(key, me) == me: return False
+    _threadlockcondition.wait_for(lambda: _threadlocks.get(key, me) == me, timeout)
+    return True
+
+def _jobinfofromlockfile(contents):
+  """
+  (jobtype, cpuid, jobid) from the contents of a lock file.
+  Raises ValueError if it's corrupt.
+  """
+  jobtype, cpuid, jobid = contents.split("\n", 1)[0].split()
+  return jobtype, int(cpuid), int(jobid)
+
+def _starttimefromlockfile(contents):
+  for line in contents.split("\n")[2:]:
+    try:
+      key, value = line.split()
+      if key == "starttime":
+        return float(value)
+    except ValueError:
+      pass
+  return None
+
+def lockfileoutputfiles(filename):
+  """
+  Output files recorded in a lock file by the job that holds it.
+  """
+  try:
+    with open(filename) as f:
+      lines = f.read().split("\n")
+  except (IOError, OSError):
+    return []
+  return [pathlib.Path(line.split(" ", 1)[1]) for line in lines[2:] if line.startswith("outputfile ")]
+
 class JobLock(object):
   defaulttimeout = datetime.timedelta(days=7)
   defaultcorruptfiletimeout = datetime.timedelta(hours=1)
   defaultminimumtimeforiterativelocks = datetime.timedelta(seconds=10)
   copyspeedlowerlimitbytespersecond = 1e6  #1 MBps
 
-  def __init__(self, filename, *, outputfiles=[], checkoutputfiles=True, inputfiles=[], checkinputfiles=True, prevsteplockfiles=[], timeout=None, corruptfiletimeout=None, minimumtimeforiterativelocks=None, mkdir=False, dosqueue=True, cachesqueue=True, suppressfileopenfailure=False):
+  def __init__(self, filename, *, outputfiles=[], checkoutputfiles=True, inputfiles=[], checkinputfiles=True, prevsteplockfiles=[], timeout=None, corruptfiletimeout=None, minimumtimeforiterativelocks=None, mkdir=False, dosqueue=True, cachesqueue=True, suppressfileopenfailure=False, completionmanifest=None, namespace=None):
+    self.name = pathlib.Path(filename)
+    self.namespace = namespace
+    if namespace is not None:
+      filename = namespace.lockfilename(filename)
+      prevsteplockfiles = [namespace.lockfilename(_) for _ in prevsteplockfiles]
     self.filename = pathlib.Path(filename)
     self.outputfiles = [pathlib.Path(_) for _ in outputfiles]
     self.inputfiles = [pathlib.Path(_) for _ in inputfiles]
@@ -275,6 +608,7 @@ class JobLock(object):
     self.dosqueue = dosqueue
     self.cachesqueue = cachesqueue
     self.suppressfileopenfailure = suppressfileopenfailure
+    self.completionmanifest = completionmanifest
     self.sublockkwargs = {
       "checkoutputfiles": checkoutputfiles,
       "checkinputfiles": checkinputfiles,
@@ -292,6 +626,10 @@ class JobLock(object):
     self.fd = self.f = None
     self.bool = False
     self.__inputsexist = self.__outputsexist = self.__prevsteplockfilesexist = self.__oldjobinfo = self.__iterative_lock = None
+    self.lockage = None
+    self.__acquiredtime = None
+    self.__registeredkey = None
+    self.__contended = False
 
   @property
   def wouldbevalid(self):
@@ -302,16 +640,24 @@ class JobLock(object):
   def runningjobinfo(self, *, exceptions=False):
     try:
       with open(self.filename) as f:
-        contents = f.read()
-        firstline = contents.split("\n")[0]
-        jobtype, cpuid, jobid = firstline.split()
-        cpuid = int(cpuid)
-        jobid = int(jobid)
-        return jobtype, cpuid, jobid
+        return _jobinfofromlockfile(f.read())
     except (IOError, OSError, ValueError):
       if exceptions: raise
       return None, None, None
 
+  def runningjobstarttime(self):
+    try:
+      with open(self.filename) as f:
+        return _starttimefromlockfile(f.read())
+    except (IOError, OSError):
+      return None
+
+  def runningjoboutputfiles(self):
+    """
+    Output files recorded in the lock file by the job that holds it.
+    """
+    return lockfileoutputfiles(self.filename)
+
   @property
   def outputsexist(self):
     return self.__outputsexist
@@ -351,16 +697,24 @@ class JobLock(object):
 
   @property
   def iterative_lock_filename(self):
+    if self.lock_iteration_number:
+      #sleep by a random amount less than 1/100 of a second to lower the probability of two jobs competing indefinitely
+      time.sleep(random.random()/100)
+    return self.__iterativelockfilename()
+
+  def __iterativelockfilename(self):
     n = self.lock_iteration_number
     if n == 0:
       return self.filename.with_suffix(self.filename.suffix+".lock")
     else:
-      #sleep by a random amount less than 1/100 of a second to lower the probability of two jobs competing indefinitely
-      time.sleep(random.random()/100)
       return self.filename.with_suffix(f".lock_{n+1}")
 
+  def __firstiterativelockfilenames(self):
+    first = self.__iterativelockfilename()
+    return first, first.with_suffix(f".lock_{self.lock_iteration_number+2}")
+
   def clean_up_iterative_locks(self):
-    iterative_lock_filename = self.iterative_lock_filename
+    iterative_lock_filename = self.__iterativelockfilename()
 
     def n_from_filename(filename):
       match = re.match("[.]lock(?:_([0-9]+))?$", filename.suffix)
@@ -385,9 +739,71 @@ class JobLock(object):
             break
 
   def __enter__(self):
+    if tracer is None:
+      return self.__acquire()
+    start = time.time()
+    try:
+      result = self.__acquire()
+    except BaseException:
+      tracer.event("attempt", self.filename, duration=time.time()-start, outcome="error")
+      raise
+    tracer.event("attempt", self.filename, duration=time.time()-start, outcome=self.outcome)
+    if self.removed_failed_job:
+      tracer.event("reclaim", self.filename, oldjob=self.oldjobinfo if isinstance(self.oldjobinfo, tuple) else None)
+    if self:
+      self.__acquiredtime = time.time()
+    return result
+
+  def __acquire(self):
+    """
+    Only one thread in this process at a time goes to the lock file.
+    Other threads that want the same lock fail right away, without
+    touching the filesystem.  The same thread trying again goes to the
+    lock file, which fails because the lock is held by this process,
+    so JobLocks aren't reentrant.
+    """
+    key = os.path.abspath(self.filename)
+    me = threading.get_ident()
+    with _threadlockcondition:
+      holder = _threadlocks.get(key)
+      if holder is not None and holder != me:
+        self.removed_failed_job = False
+        return self
+      registered = holder is None
+      if registered:
+        _threadlocks[key] = me
+    try:
+      result = self.__tryacquire()
+    finally:
+      if registered and not self:
+        self.__unregister(key)
+    self.__registeredkey = key if registered else None
+    return result
+
+  @staticmethod
+  def __unregister(key):
+    with _threadlockcondition:
+      _threadlocks.pop(key, None)
+      _threadlockcondition.notify_all()
+
+  @property
+  def outcome(self):
+    """
+    Why the last attempt to acquire the lock did or didn't succeed.
+    """
+    if self: return "acquired"
+    if self.outputsexist is not None and all(self.outputsexist.values()): return "outputsexist"
+    if self.inputsexist is not None and not all(self.inputsexist.values()): return "inputsmissing"
+    if self.prevsteplockfilesexist is not None and any(self.prevsteplockfilesexist.values()): return "prevsteplocked"
+    return "held"
+
+  def __tryacquire(self):
     self.removed_failed_job = False
     if self.checkoutputfiles and not self.filename.exists():
-      self.__outputsexist = {_: _.exists() for _ in self.outputfiles}
+      if self.completionmanifest is not None:
+        self.__outputsexist = self.completionmanifest.outputsexist(self.outputfiles)
+      else:
+        self.__outputsexist = {_: _.exists() for _ in self.outputfiles}
       if all(self.outputsexist.values()):
         self.clean_up_iterative_locks()
         return self
@@ -396,14 +812,19 @@ class JobLock(object):
       if not all(self.inputsexist.values()):
         return self
     if self.checkprevsteplockfiles:
-      self.__prevsteplockfilesexist = {_: not JobLock(_, **self.sublockkwargs).wouldbevalid for _ in self.prevsteplockfiles}
+      probe = JobLockProbe(timeout=self.timeout, corruptfiletimeout=self.corruptfiletimeout, minimumtimeforiterativelocks=self.minimumtimeforiterativelocks, dosqueue=self.dosqueue, cachesqueue=self.cachesqueue)
+      statuses = probe.statuses(self.prevsteplockfiles)
+      self.__prevsteplockfilesexist = {_: statuses[_] == JobLockProbe.HELD for _ in self.prevsteplockfiles}
       if any(self.prevsteplockfilesexist.values()):
         return self
     if self.mkdir:
       self.filename.parent.mkdir(parents=True, exist_ok=True)
+    elif self.namespace is not None:
+      self.namespace.makedirs(self.filename)
     try:
       self.__open()
     except (FileExistsError, PermissionError) as e:
+      self.__contended = True
       #PermissionError can happen because we actually don't have permissions
       #or because of network connectivity issues.
       #If the former, we want to raise the error.
@@ -423,6 +844,7 @@ class JobLock(object):
       else:
         now = datetime.datetime.now()
         age = now - modified
+      self.lockage = age
       if age is not None and self.minimumtimeforiterativelocks is not None and age < self.minimumtimeforiterativelocks:
         return self
       #check if the job died without removing the lock
@@ -458,7 +880,7 @@ class JobLock(object):
                 logger.warning(f"{self.filename} is likely corrupt (age {age}), consider setting a corrupt file timeout to remove it")
               return self
           else:
-            if age is not None and self.timeout is not None and age >= self.timeout or jobfinished(*self.oldjobinfo, dojoblist=self.dosqueue, cachejoblist=self.cachesqueue):
+            if age is not None and self.timeout is not None and age >= self.timeout or jobfinished(*self.oldjobinfo, dojoblist=self.dosqueue, cachejoblist=self.cachesqueue, starttime=self.runningjobstarttime()):
               for outputfile in self.outputfiles:
                 rm_missing_ok(outputfile)
               rm_missing_ok(self.filename)
@@ -479,8 +901,14 @@ class JobLock(object):
 
     self.f = os.fdopen(self.fd, 'w')
 
-    message = " ".join(str(_) for _ in jobinfo())
-    message += "\n" + socket.gethostname()
+    message = jobheader()
+    if self.namespace is not None and "\n" not in os.fspath(self.name):
+      #the lock file name doesn't say what it's for
+      message += f"\nname {os.path.abspath(self.name)}"
+    for outputfile in self.outputfiles:
+      #so that the outputs can be cleaned up if the job dies, without knowing what they are
+      if "\n" not in os.fspath(outputfile):
+        message += f"\noutputfile {os.path.abspath(outputfile)}"
     try:
       self.f.write(message+"\n")
     except (IOError, OSError):
@@ -490,18 +918,31 @@ class JobLock(object):
     except (IOError, OSError):
       pass
     self.bool = True
+    _heldjoblocks[self] = None
     return self
 
   def __exit__(self, exc_type, exc, traceback):
+    _heldjoblocks.pop(self, None)
+    if self and tracer is not None and self.__acquiredtime is not None:
+      tracer.event("release", self.filename, held=time.time()-self.__acquiredtime, failed=exc is not None)
     if self:
       #clean up output files if job failed
       if exc is not None:
         for outputfile in self.outputfiles:
           rm_missing_ok(outputfile)
-      #clean up iterative locks whose jobs died
-      self.clean_up_iterative_locks()
+      elif self.completionmanifest is not None:
+        self.completionmanifest.record(self.outputfiles)
+      #clean up iterative locks whose jobs died.  If nobody tried to take the lock
+      #while we held it, listing the folder is usually a waste of time, so only do
+      #it if the first or second iterative lock file is there.  (The second one is
+      #left behind when its job died after the first one was released.)  Stale
+      #ones further down the chain are cleaned up the next time the lock is contended.
+      if self.__contended or any(os.path.lexists(_) for _ in self.__firstiterativelockfilenames()):
+        self.clean_up_iterative_locks()
       #remove this lock file
       rm_missing_ok(self.filename)
+    if self.__registeredkey is not None:
+      self.__unregister(self.__registeredkey)
     self.__reset()
 
   def __bool__(self):
@@ -528,11 +969,130 @@ class JobLock(object):
   def setdefaultminimumtimeforiterativelocks(cls, timeout):
     cls.defaultminimumtimeforiterativelocks = timeout
 
+class JobLockProbe(object):
+  """
+  Finds out whether lock files are free, held by a job that's still running,
+  or stale, without trying to acquire them.  The jobs holding the locks are
+  checked with one job list command per batch system.
+  Lock files that haven't changed since they were last read, in this process,
+  aren't read again.
+  """
+  FREE = "free"
+  HELD = "held"
+  STALE = "stale"
+
+  maxcachesize = 100000
+  __cache = {}
+  __cachelock = threading.Lock()
+
+  def __init__(self, *, timeout=None, corruptfiletimeout=None, minimumtimeforiterativelocks=None, dosqueue=True, cachesqueue=True):
+    if timeout is None: timeout = JobLock.defaulttimeout
+    if corruptfiletimeout is None: corruptfiletimeout = JobLock.defaultcorruptfiletimeout
+    if minimumtimeforiterativelocks is None: minimumtimeforiterativelocks = JobLock.defaultminimumtimeforiterativelocks
+    self.timeout = timeout
+    self.corruptfiletimeout = corruptfiletimeout
+    self.minimumtimeforiterativelocks = minimumtimeforiterativelocks
+    self.dosqueue = dosqueue
+    self.cachesqueue = cachesqueue
+
+  @classmethod
+  def readlockfile(cls, filename):
+    """
+    Returns (modification time, (jobtype, cpuid, jobid) or the exception from reading it, start time),
+    or None if the lock file doesn't exist.
+    """
+    filename = pathlib.Path(filename)
+    try:
+      stat = filename.stat()
+    except FileNotFoundError:
+      return None
+    key = stat.st_ino, stat.st_mtime_ns, stat.st_size
+    cached = cls.__cache.get(filename)
+    if cached is not None and cached[0] == key:
+      return cached[1]
+
+    starttime = None
+    try:
+      with open(filename) as f:
+        contents = f.read()
+    except FileNotFoundError:
+      return None
+    except (IOError, OSError) as e:
+      info = e
+    else:
+      try:
+        info = _jobinfofromlockfile(contents)
+      except ValueError as e:
+        info = e
+      starttime = _starttimefromlockfile(contents)
+    result = datetime.datetime.fromtimestamp(stat.st_mtime), info, starttime
+    with cls.__cachelock:
+      #forget the oldest entries first
+      cls.__cache.pop(filename, None)
+      while len(cls.__cache) >= cls.maxcachesize:
+        del cls.__cache[next(iter(cls.__cache))]
+      cls.__cache[filename] = key, result
+    return result
+
+  def statuses(self, filenames):
+    return self.statusesfromrecords({filename: self.readlockfile(filename) for filename in filenames})
+
+  def statusesfromrecords(self, records):
+    """
+    Same as statuses, but takes a dict {filename: readlockfile(filename)}.
+    """
+    statuses = {}
+    tocheck = collections.defaultdict(dict)
+    now = datetime.datetime.now()
+    for filename, record in records.items():
+      if record is None:
+        statuses[filename] = self.FREE
+        continue
+      modified, info, starttime = record
+      age = now - modified
+      if self.timeout is not None and age >= self.timeout:
+        statuses[filename] = self.STALE
+      elif self.minimumtimeforiterativelocks is not None and age < self.minimumtimeforiterativelocks:
+        statuses[filename] = self.HELD
+      elif isinstance(info, ValueError):
+        if self.corruptfiletimeout is not None and age >= self.corruptfiletimeout:
+          statuses[filename] = self.STALE
+        else:
+          statuses[filename] = self.HELD
+      elif isinstance(info, Exception):
+        statuses[filename] = self.HELD
+      else:
+        jobtype, cpuid, jobid = info
+        tocheck[jobtype][filename] = (cpuid, jobid), starttime
+
+    for jobtype, jobs in tocheck.items():
+      if any(system.jobtype() == jobtype for system in batchsubmissionsystems):
+        finished = jobsfinished(jobtype, {job for job, starttime in jobs.values()}, dojoblist=self.dosqueue, cachejoblist=self.cachesqueue)
+      else:
+        finished = {job: jobfinished(jobtype, *job, starttime=starttime) for job, starttime in jobs.values()}
+      for filename, (job, starttime) in jobs.items():
+        statuses[filename] = self.STALE if finished[job] else self.HELD
+
+    return statuses
+
+  def status(self, filename):
+    return self.statuses([filename])[filename]
+
 def clear_running_jobs_cache():
   for system in batchsubmissionsystems:
     system.clearrunningjobscache()
 
-def jobfinished(jobtype, cpuid, jobid, *, dojoblist=True, cachejoblist=True):
+def jobsfinished(jobtype, jobs, *, dojoblist=True, cachejoblist=True):
+  for system in batchsubmissionsystems:
+    try:
+      return system.jobsfinished(jobtype, jobs, dojoblist=dojoblist, cachejoblist=cachejoblist)
+    except BatchSubmissionSystem.WrongBatchSystemError:
+      pass
+
+  else:
+    return {(cpuid, jobid): jobfinished(jobtype, cpuid, jobid, dojoblist=dojoblist, cachejoblist=cachejoblist) for cpuid, jobid in jobs}
+
+def jobfinished(jobtype, cpuid, jobid, *, dojoblist=True, cachejoblist=True, starttime=None):
   for system in batchsubmissionsystems:
     try:
       return system.jobfinished(jobtype=jobtype, cpuid=cpuid, jobid=jobid, dojoblist=dojoblist, cachejoblist=cachejoblist)
@@ -544,74 +1104,265 @@ def jobfinished(jobtype, cpuid, jobid, *, dojoblist=True, cachejoblist=True):
     if myjobtype != jobtype: return None #we don't know if the job finished
     if mycpuid != cpuid: return None #we don't know if the job finished
     if jobid == myjobid: return False #job is still running
-    if sys.platform == "cygwin":
-      psoutput = subprocess.check_output(["ps", "-s"])
-      lines = psoutput.split(b"\n")
-      for line in lines[1:]:
-        if not line: continue
-        if int(line.split(maxsplit=1)[0]) == jobid:
-          return False #job is still running
-      return True #job is finished
-    else:
-      for process in psutil.process_iter():
-        if jobid == process.pid:
-          return False #job is still running
-      return True #job is finished
+    return not processrunning(jobid, starttime)
 
 class JobLockAndWait(JobLock):
   defaultsilent = False
+  #weight of the newest hold time in the running average
+  holdtimeweight = 0.3
 
-  def __init__(self, name, delay, *, printmessage=None, task="doing this", maxiterations=1000, silent=None, waitforinputs=False, **kwargs):
+  def __init__(self, name, delay, *, printmessage=None, task="doing this", maxiterations=1000, silent=None, waitforinputs=False, fair=False, adaptive=False, maxdelay=None, **kwargs):
     super().__init__(name, **kwargs)
     self.delay = delay
     if printmessage is None:
-      printmessage = f"Another process is already {task}.  Waiting {delay} seconds."
+      if adaptive:
+        printmessage = f"Another process is already {task}.  Waiting for it to finish."
+      else:
+        printmessage = f"Another process is already {task}.  Waiting {delay} seconds."
     self.__printmessage = printmessage
     if silent is None:
       silent = self.defaultsilent
     self.__silent = silent
     self.__waitforinputs = waitforinputs
+    self.__fair = fair
+    self.__adaptive = adaptive
+    if maxdelay is None: maxdelay = 64 * delay
+    self.maxdelay = maxdelay
     self.niterations = 0
     self.maxiterations = maxiterations
+    self.__acquiredtime = None
+
+  @property
+  def holdtimefilename(self):
+    return self.filename.with_name(self.filename.name + ".holdtime")
+
+  def readholdtime(self):
+    """
+    Running average of how long, in seconds, adaptive JobLockAndWaits
+    have held this lock in the past, or None if that isn't known.
+    """
+    try:
+      with open(self.holdtimefilename) as f:
+        return float(f.read())
+    except (IOError, OSError, ValueError):
+      return None
+
+  def recordholdtime(self, holdtime):
+    previous = self.readholdtime()
+    if previous is not None:
+      holdtime = self.holdtimeweight * holdtime + (1 - self.holdtimeweight) * previous
+    tmpfilename = self.holdtimefilename.with_name(f"{self.holdtimefilename.name}.{os.getpid()}")
+    try:
+      with open(tmpfilename, "w") as f:
+        f.write(f"{holdtime!r}\n")
+      os.replace(tmpfilename, self.holdtimefilename)
+    except (IOError, OSError):
+      pass
+    finally:
+      rm_missing_ok(tmpfilename)
+
+  def __nextdelay(self, holdtime, position=0):
+    """
+    position is the number of other waiters ahead of this one in fair mode
+    """
+    if not self.__adaptive:
+      return self.delay * max(position, 1)
+    delay = None
+    if holdtime is not None:
+      #wait until the current holder, and the waiters ahead of us, are expected to be done
+      remaining = holdtime * (position + 1)
+      if position == 0 and self.lockage is not None:
+        remaining -= self.lockage.total_seconds()
+      if remaining > 0: delay = remaining
+    if delay is None:
+      #exponential backoff
+      delay = self.delay * max(position, 1) * 2**min(self.niterations-1, 30)
+    delay = max(self.delay, min(delay, self.maxdelay))
+    return min(delay, max(self.deadline - time.monotonic(), 0))
+
+  @property
+  def ticketcounterfilename(self):
+    return self.filename.with_name(self.filename.name + ".ticket")
+
+  def ticketfilename(self, n):
+    return self.filename.with_name(f"{self.filename.name}.ticket_{n}")
+
+  @property
+  def ticketcounterlockfilename(self):
+    return self.ticketcounterfilename.with_name(self.ticketcounterfilename.name + ".lock")
+
+  def __getticket(self):
+    """
+    Get in line for the lock: take the next number from the ticket counter
+    and hold a JobLock on the ticket file with that number while waiting.
+    """
+    if self.namespace is not None:
+      self.namespace.makedirs(self.filename)
+    #the ticket file is created before the counter lock is released, so that
+    #nobody can reset the counter and get in line ahead of us in between
+    with JobLockAndWait(self.ticketcounterlockfilename, self.delay/10, silent=True, dosqueue=self.dosqueue, cachesqueue=self.cachesqueue, mkdir=self.mkdir):
+      try:
+        with open(self.ticketcounterfilename) as f:
+          n = int(f.read())
+      except (FileNotFoundError, ValueError):
+        n = 0
+      while True:
+        ticket = JobLock(self.ticketfilename(n), **self.sublockkwargs)
+        if ticket.__enter__(): break
+        #left over from before the counter was reset
+        n += 1
+      try:
+        with open(self.ticketcounterfilename, "w") as f:
+          f.write(f"{n+1}\n")
+      except BaseException as e:
+        ticket.__exit__(type(e), e, e.__traceback__)
+        raise
+    return n, ticket
+
+  def __releaseticket(self, ticket):
+    ticket.__exit__(None, None, None)
+    #if nobody else is in line, remove the counter so that the next one starts from 0
+    with JobLock(self.ticketcounterlockfilename, **self.sublockkwargs) as lock:
+      if not lock: return #someone is getting a ticket right now
+      if any(self.__tickets()): return
+      rm_missing_ok(self.ticketcounterfilename)
+
+  def __tickets(self):
+    for filename in self.filename.parent.glob(self.ticketfilename("*").name):
+      try:
+        yield int(filename.name.rsplit("_", 1)[1]), filename
+      except ValueError:
+        continue
+
+  def __queueposition(self, n):
+    """
+    How many live tickets are ahead of ticket n.  Tickets left behind
+    by jobs that died are removed.
+    """
+    older = [filename for othern, filename in self.__tickets() if othern < n]
+    statuses = JobLockProbe(dosqueue=self.dosqueue, cachesqueue=self.cachesqueue).statuses(older)
+    position = 0
+    for filename, status in statuses.items():
+      if status == JobLockProbe.STALE:
+        #the JobLock decides again, safely, whether to remove it
+        with JobLock(filename, **self.sublockkwargs):
+          pass
+      elif status == JobLockProbe.HELD:
+        position += 1
+    return position
 
   def __enter__(self):
-    for self.niterations in itertools.count(1):
-      if self.niterations > self.maxiterations:
-        raise RuntimeError(f"JobLockAndWait still did not succeed after {self.maxiterations} iterations")
-      result = super().__enter__()
-      if result:
-        return result
-      elif self.checkoutputfiles and self.outputsexist is not None and all(self.outputsexist.values()):
-        return result
-      elif self.checkinputfiles and self.inputsexist is not None:
-        missinginputs = [k for k, v in self.inputsexist.items() if not v]
-        if missinginputs:
-          message = f"Some input files are missing: {', '.join(str(_) for _ in missinginputs)}."
-          if self.__waitforinputs:
-            if not self.__silent: print(f"{message} Waiting {self.delay} seconds.")
-          else:
-            raise FileNotFoundError(message)
-      else:
-        if not self.__silent: print(self.__printmessage)
-      time.sleep(self.delay * (1 + 0.1 * (random.random() - 0.5)))
+    n = ticket = holdtime = None
+    if self.__adaptive:
+      #maxiterations is interpreted as a total time of maxiterations * delay
+      self.deadline = time.monotonic() + self.maxiterations * self.delay
+      holdtime = self.readholdtime()
+    if self.__fair:
+      n, ticket = self.__getticket()
+    start = time.time()
+    try:
+      for self.niterations in itertools.count(1):
+        if self.__adaptive:
+          if self.niterations > 1 and time.monotonic() >= self.deadline:
+            raise RuntimeError(f"JobLockAndWait still did not succeed after {self.maxiterations * self.delay} seconds")
+        elif self.niterations > self.maxiterations:
+          raise RuntimeError(f"JobLockAndWait still did not succeed after {self.maxiterations} iterations")
+        if ticket is not None:
+          position = self.__queueposition(n)
+          if position:
+            #the jobs ahead of us go first
+            delay = self.__nextdelay(holdtime, position)
+            if not self.__silent: print(f"{position} other processes are waiting ahead of this one.  Waiting {delay:.3g} seconds.")
+            self.__sleep(delay * (1 + 0.1 * (random.random() - 0.5)))
+            continue
+        result = super().__enter__()
+        if result:
+          self.__acquiredtime = time.monotonic()
+          return result
+        elif self.checkoutputfiles and self.outputsexist is not None and all(self.outputsexist.values()):
+          return result
+        elif self.checkinputfiles and self.inputsexist is not None:
+          missinginputs = [k for k, v in self.inputsexist.items() if not v]
+          if missinginputs:
+            message = f"Some input files are missing: {', '.join(str(_) for _ in missinginputs)}."
+            if self.__waitforinputs:
+              if not self.__silent: print(f"{message} Waiting {self.delay} seconds.")
+            else:
+              raise FileNotFoundError(message)
+        else:
+          if not self.__silent: print(self.__printmessage)
+        self.__sleep(self.__nextdelay(holdtime) * (1 + 0.1 * (random.random() - 0.5)))
+    finally:
+      if ticket is not None:
+        self.__releaseticket(ticket)
+      if tracer is not None:
+        tracer.event("waitdone", self.filename, duration=time.time()-start, iterations=self.niterations, outcome=self.outcome)
+
+  def __sleep(self, delay):
+    if tracer is not None:
+      tracer.event("wait", self.filename, duration=delay, iteration=self.niterations)
+    #if another thread in this process has the lock, wake up as soon as it's released
+    if not _waitforotherthread(self.filename, delay):
+      time.sleep(delay)
 
-def clean_up_old_job_locks(*folders, glob="*.lock_*", howold=datetime.timedelta(days=7), dryrun=False, silent=False):
+  def __exit__(self, exc_type, exc, traceback):
+    if self and self.__adaptive and self.__acquiredtime is not None:
+      self.recordholdtime(time.monotonic() - self.__acquiredtime)
+    self.__acquiredtime = None
+    return super().__exit__(exc_type, exc, traceback)
+
+def _rglob(folder, glob, *, executor):
+  """
+  Like folder.rglob(glob), but the directories at each level of the tree
+  are listed in parallel, which is a lot faster on network filesystems
+  when there are many directories (e.g. a LockNamespace).
+  """
+  def scan(directory):
+    matches = []
+    subdirectories = []
+    try:
+      with os.scandir(directory) as it:
+        for entry in it:
+          if entry.is_dir(follow_symlinks=False):
+            subdirectories.append(entry.path)
+          elif fnmatch.fnmatchcase(entry.name, glob):
+            matches.append(pathlib.Path(entry.path))
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+      pass
+    return matches, subdirectories
+
+  result = []
+  directories = [folder]
+  while directories:
+    nextdirectories = []
+    for matches, subdirectories in executor.map(scan, directories):
+      result += matches
+      nextdirectories += subdirectories
+    directories = nextdirectories
+  return result
+
+def clean_up_old_job_locks(*folders, glob="*.lock_*", howold=datetime.timedelta(days=7), dryrun=False, silent=False, maxworkers=None):
   for folder in folders:
     folder = pathlib.Path(folder)
-    all_locks = sorted(folder.rglob(glob))
-    all_first_order_locks = sorted({filename.with_suffix(filename.suffix.split("_")[0]) for filename in all_locks})
-    locks_dict = {first_order_lock: {lock for lock in all_locks if lock.with_suffix(lock.suffix.split("_")[0]) == first_order_lock} for first_order_lock in all_first_order_locks}
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(max_workers=maxworkers) as executor:
+      all_locks = _rglob(folder, glob, executor=executor)
+      locks_dict = collections.defaultdict(list)
+      for lock in all_locks:
+        locks_dict[lock.with_suffix(lock.suffix.split("_")[0])].append(lock)
+
+      def lastmodified(lock_files):
+        try:
+          return max(datetime.datetime.fromtimestamp(file.stat().st_mtime) for file in lock_files)
+        except FileNotFoundError:
+          return None
+      modifieds = dict(zip(locks_dict, executor.map(lastmodified, locks_dict.values())))
 
     remove = []
     dontremove = []
-    for first_order_lock_file, lock_files in sorted(locks_dict.items()):
-      try:
-        modified = max(datetime.datetime.fromtimestamp(file.stat().st_mtime) for file in lock_files)
-      except FileNotFoundError:
-        dontremove.append(first_order_lock_file)
-        continue
-      now = datetime.datetime.now()
-      if now - modified < howold:
+    now = datetime.datetime.now()
+    for first_order_lock_file, modified in sorted(modifieds.items()):
+      if modified is None or now - modified < howold:
         dontremove.append(first_order_lock_file)
       else:
         remove.append(first_order_lock_file)
@@ -637,12 +1388,14 @@ def clean_up_old_job_locks(*folders, glob="*.lock_*", howold=datetime.timedelta(
     for _ in dontremove: doprint(_)
 
 def clean_up_old_job_locks_argparse(args=None):
+  import argparse
   p = argparse.ArgumentParser()
   p.add_argument("folders", type=pathlib.Path, nargs="+", metavar="folder")
   p.add_argument("--glob", default="*.lock_*")
   p.add_argument("--hours-old", type=lambda x: datetime.timedelta(hours=float(x)), default=datetime.timedelta(days=7), dest="howold")
   p.add_argument("--dry-run", dest="dryrun", action="store_true")
   p.add_argument("--silent", action="store_true")
+  p.add_argument("--max-workers", type=int, dest="maxworkers", help="number of threads to use to scan the folders")
   args = p.parse_args(args=args)
   folders = args.__dict__.pop("folders")
   return clean_up_old_job_locks(*folders, **args.__dict__)
@@ -671,9 +1424,11 @@ def add_job_lock_arguments(argumentparser):
   g = p.add_mutually_exclusive_group()
   g.add_argument("--squeue-output", help="output of 'squeue --Format jobid,state --noheader'")
   g.add_argument("--squeue-output-file", type=pathlib.Path, help="file containing the output of 'squeue --Format jobid,state --noheader'")
+  g.add_argument("--watch-squeue-output-file", type=pathlib.Path, help="like --squeue-output-file, but read the file again whenever it changes (see job_lock publish-job-list)")
   g = p.add_mutually_exclusive_group()
-  g.add_argument("--condorq-output", help="output of 'condor_q -nobatch'")
-  g.add_argument("--condorq-output-file", type=pathlib.Path, help="file containing the output of 'condor_q -nobatch'")
+  g.add_argument("--condorq-output", help="output of 'condor_q -af ClusterId ProcId JobStatus'")
+  g.add_argument("--condorq-output-file", type=pathlib.Path, help="file containing the output of 'condor_q -af ClusterId ProcId JobStatus'")
+  g.add_argument("--watch-condorq-output-file", type=pathlib.Path, help="like --condorq-output-file, but read the file again whenever it changes (see job_lock publish-job-list)")
 
   def parsetimedelta(s):
     regex = r"(?P<hours>\d+):(?P<minutes>\d+):(?P<seconds>\d+(?:\.\d*)?)$"
@@ -684,11 +1439,21 @@ def add_job_lock_arguments(argumentparser):
   p.add_argument("--job-lock-timeout", type=parsetimedelta, help=f"delete joblock files after this long (%%H:%%M:%%S, default {JobLock.defaulttimeout})")
   p.add_argument("--corrupt-job-lock-timeout", type=parsetimedelta, help=f"delete corrupt joblock files after this long (%%H:%%M:%%S, default {JobLock.defaultcorruptfiletimeout})")
   p.add_argument("--minimum-time-for-iterative-locks", type=parsetimedelta, help=f"if the lock has existed for at least this long, check if the job is still running and, if not, delete the lock (%%H:%%M:%%S, default {JobLock.defaultminimumtimeforiterativelocks})")
+  p.add_argument("--job-list-output-max-age", type=parsetimedelta, help=f"ignore a watched squeue or condor_q output file if it hasn't been updated for this long (%%H:%%M:%%S, default {BatchSubmissionSystem.defaultjoblistoutputmaxage})")
+  p.add_argument("--job-list-timeout", type=parsetimedelta, help=f"give up on squeue or condor_q if it takes longer than this (%%H:%%M:%%S, default {BatchSubmissionSystem.defaultjoblisttimeout})")
+  p.add_argument("--job-lock-trace-dir", type=pathlib.Path, help="write a trace of the lock activity to a file in this folder")
 
 def process_job_lock_arguments(parsed_args):
   dct = parsed_args.__dict__
-  setsqueueoutput(output=dct.pop("squeue_output"), filename=dct.pop("squeue_output_file"))
-  setcondorqoutput(output=dct.pop("condorq_output"), filename=dct.pop("condorq_output_file"))
+  maxage = dct.pop("job_list_output_max_age")
+  for setoutput, name in (setsqueueoutput, "squeue"), (setcondorqoutput, "condorq"):
+    output = dct.pop(f"{name}_output")
+    filename = dct.pop(f"{name}_output_file")
+    watchedfile = dct.pop(f"watch_{name}_output_file")
+    if watchedfile is not None:
+      setoutput(filename=watchedfile, watch=True, maxage=maxage)
+    else:
+      setoutput(output=output, filename=filename)
 
   timeout = dct.pop("corrupt_job_lock_timeout")
   JobLock.setdefaultcorruptfiletimeout(timeout)
@@ -696,3 +1461,10 @@ def process_job_lock_arguments(parsed_args):
   JobLock.setdefaultminimumtimeforiterativelocks(timeout)
   timeout = dct.pop("job_lock_timeout")
   JobLock.setdefaulttimeout(timeout)
+  timeout = dct.pop("job_list_timeout")
+  if timeout is not None:
+    BatchSubmissionSystem.setdefaultjoblisttimeout(timeout)
+  tracedir = dct.pop("job_lock_trace_dir")
+  if tracedir is not None:
+    from .trace import enable_tracing #trace imports this module
+    enable_tracing(tracedir)
@@ -0,0 +1,46 @@
+import hashlib, os, pathlib
+
+class LockNamespace(object):
+  """
+  Maps lock names to files in a hashed directory tree, so that no single
+  directory ends up with a huge number of lock files (and their .lock_N
+  iterations) in it.  Pass it to JobLock and friends as namespace=...
+
+  The lock for /path/to/output.lock goes in
+    root/ab/cd/abcd0123456789ef_output.lock
+  where abcd0123456789ef... is a hash of the absolute path.  With the
+  default fanout of 2 levels of 256 directories each, 10^7 locks come
+  out to about 150 per directory.
+
+  If root is None, the tree goes in a .job_locks folder next to each lock.
+  """
+  defaultdirname = ".job_locks"
+
+  def __init__(self, root=None, *, fanout=2):
+    if root is not None: root = pathlib.Path(root)
+    self.root = root
+    self.fanout = fanout
+    self.__createddirs = set()
+
+  def lockfilename(self, name):
+    name = pathlib.Path(os.path.abspath(name))
+    h = hashlib.sha1(os.fsencode(name)).hexdigest()
+    root = self.root
+    if root is None: root = name.parent/self.defaultdirname
+    folder = root.joinpath(*(h[2*i:2*i+2] for i in range(self.fanout)))
+    return folder/f"{h[:16]}_{name.name}"
+
+  def __call__(self, name):
+    return self.lockfilename(name)
+
+  def makedirs(self, lockfilename):
+    """
+    Create the directory for lockfilename, if this process hasn't already.
+    """
+    folder = pathlib.Path(lockfilename).parent
+    if folder in self.__createddirs: return
+    folder.mkdir(parents=True, exist_ok=True)
+    self.__createddirs.add(folder)
+
+  def __repr__(self):
+    return f"{type(self).__name__}({self.root!r}, fanout={self.fanout})"
@@ -0,0 +1,80 @@
+import os, signal, threading, time
+from .job_lock import held_job_locks, logger
+from .slurm_tmpdir import slurm_flush_outputs
+
+class JobPreempted(Exception):
+  pass
+
+def release_all_job_locks(reason="job preempted"):
+  """
+  Release every JobLock held by this process, removing their output files
+  as if the with block had raised an exception.
+  """
+  exc = JobPreempted(reason)
+  for lock in reversed(held_job_locks()):
+    try:
+      lock.__exit__(type(exc), exc, None)
+    except Exception:
+      logger.exception("Failed to release %s", lock.filename)
+
+class _PreemptionHandler(object):
+  def __init__(self):
+    self.previoushandlers = {}
+    self.timer = None
+
+  def handle(self, signum, frame):
+    logger.warning("Received signal %s, releasing job locks", signum)
+    self.uninstall()
+    release_all_job_locks(f"received signal {signum}")
+    try:
+      slurm_flush_outputs()
+    except Exception:
+      logger.exception("Failed to copy pending outputs")
+    previous = signal.getsignal(signum)
+    if callable(previous):
+      previous(signum, frame)
+    elif previous == signal.SIG_DFL:
+      os.kill(os.getpid(), signum)
+
+  def install(self, signals, graceperiod):
+    for signum in signals:
+      self.previoushandlers[signum] = signal.signal(signum, self.handle)
+    if graceperiod is not None and "SLURM_JOB_END_TIME" in os.environ:
+      #Slurm only sends SIGTERM when the time limit is reached,
+      #so send the first signal ourselves a bit earlier
+      endtime = float(os.environ["SLURM_JOB_END_TIME"])
+      delay = endtime - graceperiod.total_seconds() - time.time()
+      self.timer = threading.Timer(max(delay, 0), os.kill, args=(os.getpid(), signals[0]))
+      self.timer.daemon = True
+      self.timer.start()
+
+  def uninstall(self):
+    if self.timer is not None:
+      self.timer.cancel()
+      self.timer = None
+    for signum, previous in self.previoushandlers.items():
+      signal.signal(signum, previous)
+    self.previoushandlers.clear()
+
+_handler = None
+
+def install_preemption_handler(signals=(signal.SIGTERM, signal.SIGINT), *, graceperiod=None):
+  """
+  When any of the signals is received, release all the JobLocks held by
+  this process (removing their output files), copy the outputs pending from
+  slurm_rsync_output(..., deferred=True), and then pass the signal on to
+  the previous handler.
+  If graceperiod (a timedelta) is given and SLURM_JOB_END_TIME is set,
+  the same thing happens that long before the job's time limit.
+  Has to be called from the main thread.
+  """
+  global _handler
+  uninstall_preemption_handler()
+  _handler = _PreemptionHandler()
+  _handler.install(tuple(signals), graceperiod)
+
+def uninstall_preemption_handler():
+  global _handler
+  if _handler is not None:
+    _handler.uninstall()
+    _handler = None
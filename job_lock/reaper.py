@@ -0,0 +1,67 @@
+import contextlib, itertools, time
+from .inventory import lock_inventory
+from .job_lock import batchsubmissionsystems, JobLock, lockfileoutputfiles, logger
+
+def reap_stale_locks(*folders, glob=None, dryrun=False, snapshot=True, maxworkers=None, **probekwargs):
+  """
+  Find lock files under folders whose jobs have finished and remove them,
+  along with the output files those jobs recorded in them, so that the next
+  job that wants the lock doesn't have to do it.  glob is passed to
+  lock_inventory.
+
+  If snapshot is True, all the jobs are listed once for each batch system,
+  and that listing is used for every lock, as if it had been given to
+  setsqueueoutput.  Jobs submitted after the listing was made are never
+  considered finished, so a lock acquired in the meantime is safe.
+
+  Each lock is removed by acquiring and releasing a JobLock on it, so the
+  decision whether to remove it is made again under the usual iterative
+  lock and is safe against other jobs doing the same thing.
+  Returns the lock files that were (or, if dryrun, would be) removed.
+  """
+  #a long running reaper shouldn't assume that jobs it once saw are still running
+  probekwargs.setdefault("cachesqueue", False)
+  with contextlib.ExitStack() as stack:
+    if snapshot:
+      for system in batchsubmissionsystems:
+        stack.enter_context(system.temporaryjoblistoutput(output=system.alljobsoutput()))
+      #don't run the job list command lock by lock if the listing failed
+      probekwargs["dosqueue"] = False
+    inventory = lock_inventory(*folders, glob=glob, maxworkers=maxworkers, **probekwargs)
+    reaped = []
+    for lock in inventory:
+      if not lock.reclaimable: continue
+      if dryrun:
+        reaped.append(lock.filename)
+        continue
+      outputfiles = lockfileoutputfiles(lock.filename)
+      try:
+        with JobLock(lock.filename, outputfiles=outputfiles, checkoutputfiles=False, checkinputfiles=False, **probekwargs) as joblock:
+          if joblock and joblock.removed_failed_job:
+            logger.info(f"Removed {lock.filename} and its outputs, which were left behind by {lock.jobtype} {lock.cpuid} {lock.jobid}")
+            reaped.append(lock.filename)
+          #otherwise someone else got to it first or it isn't stale after all
+      except OSError as e:
+        #e.g. the lock's folder was removed since the scan
+        logger.warning(f"Couldn't reap {lock.filename}: {e!r}")
+    return reaped
+
+def run_reaper(*folders, interval=None, cycles=None, silent=False, **kwargs):
+  """
+  Run reap_stale_locks every interval seconds (once if interval is None),
+  for cycles cycles or forever.  If a cycle fails, the error is logged
+  and the reaper tries again in the next one.
+  """
+  for cycle in itertools.count(1):
+    start = time.monotonic()
+    try:
+      reaped = reap_stale_locks(*folders, **kwargs)
+    except Exception:
+      if interval is None: raise
+      logger.exception("Reaper cycle failed, trying again in the next one")
+      reaped = []
+    if not silent:
+      verb = "Would remove" if kwargs.get("dryrun") else "Removed"
+      for filename in reaped: print(f"{verb} {filename}")
+    if interval is None or cycles is not None and cycle >= cycles: return
+    time.sleep(max(interval - (time.monotonic() - start), 0))
@@ -0,0 +1,84 @@
+import itertools, pathlib, random, time
+from .job_lock import JobLock, JobLockProbe
+
+class JobSemaphore(object):
+  """
+  Like a JobLock, but up to `slots` jobs can hold it at the same time.
+  Each slot is a JobLock on name.slot_i, so slots held by jobs that died
+  are reclaimed in the same way as stale locks.  The slots are checked
+  with a single JobLockProbe, so a full semaphore costs one job list
+  command rather than one per slot.
+
+  Keyword arguments are passed to the JobLocks on the slots.  Don't pass
+  outputfiles: they would be removed when a different job's slot is reclaimed.
+  """
+  def __init__(self, name, slots, **kwargs):
+    if slots < 1: raise ValueError(f"slots has to be at least 1, not {slots}")
+    self.name = pathlib.Path(name)
+    self.slots = slots
+    #the slot names, not the semaphore name, go through the namespace
+    self.namespace = kwargs.pop("namespace", None)
+    self.__kwargs = kwargs
+    self.__lock = None
+    self.slot = None
+
+  def slotfilename(self, i):
+    filename = self.name.with_name(f"{self.name.name}.slot_{i}")
+    if self.namespace is not None:
+      filename = self.namespace.lockfilename(filename)
+    return filename
+
+  @property
+  def slotfilenames(self):
+    return [self.slotfilename(i) for i in range(self.slots)]
+
+  def __enter__(self):
+    if self.__lock is not None: raise RuntimeError(f"Already holding slot {self.slot} of {self.name}")
+    probekwargs = {k: v for k, v in self.__kwargs.items() if k in ("timeout", "corruptfiletimeout", "minimumtimeforiterativelocks", "dosqueue", "cachesqueue")}
+    statuses = JobLockProbe(**probekwargs).statuses(self.slotfilenames)
+    candidates = [i for i, filename in enumerate(self.slotfilenames) if statuses[filename] != JobLockProbe.HELD]
+    #spread the jobs over the slots so that they don't all compete for the first one
+    random.shuffle(candidates)
+    for i in candidates:
+      if self.namespace is not None:
+        self.namespace.makedirs(self.slotfilename(i))
+      lock = JobLock(self.slotfilename(i), **self.__kwargs)
+      if lock.__enter__():
+        self.__lock = lock
+        self.slot = i
+        break
+    return self
+
+  def __exit__(self, exc_type, exc, traceback):
+    if self.__lock is not None:
+      self.__lock.__exit__(exc_type, exc, traceback)
+    self.__lock = None
+    self.slot = None
+
+  def __bool__(self):
+    return self.__lock is not None
+
+class JobSemaphoreAndWait(JobSemaphore):
+  defaultsilent = False
+
+  def __init__(self, name, slots, delay, *, printmessage=None, task="doing this", maxiterations=1000, silent=None, **kwargs):
+    super().__init__(name, slots, **kwargs)
+    self.delay = delay
+    if printmessage is None:
+      printmessage = f"{slots} other processes are already {task}.  Waiting {delay} seconds."
+    self.__printmessage = printmessage
+    if silent is None:
+      silent = self.defaultsilent
+    self.__silent = silent
+    self.niterations = 0
+    self.maxiterations = maxiterations
+
+  def __enter__(self):
+    for self.niterations in itertools.count(1):
+      if self.niterations > self.maxiterations:
+        raise RuntimeError(f"JobSemaphoreAndWait still did not succeed after {self.maxiterations} iterations")
+      result = super().__enter__()
+      if result:
+        return result
+      if not self.__silent: print(self.__printmessage)
+      time.sleep(self.delay * (1 + 0.1 * (random.random() - 0.5)))
@@ -0,0 +1,92 @@
+import functools, hashlib, inspect, os, pathlib, pickle
+from .job_lock import JobLockAndWait, rm_missing_ok
+
+def _pickleload(filename):
+  with open(filename, "rb") as f:
+    return pickle.load(f)
+
+def _pickledump(result, filename):
+  with open(filename, "wb") as f:
+    pickle.dump(result, f)
+
+def _canonical(value):
+  """
+  A string that's the same for equal arguments in every process:
+  dicts and sets are sorted, and anything whose repr might change
+  from one process to the next isn't allowed.
+  """
+  if value is None or isinstance(value, (bool, int, float, complex, str, bytes, pathlib.PurePath)):
+    return repr(value)
+  if isinstance(value, (list, tuple)):
+    return f"{type(value).__name__}({', '.join(_canonical(_) for _ in value)})"
+  if isinstance(value, (set, frozenset)):
+    return f"{type(value).__name__}({', '.join(sorted(_canonical(_) for _ in value))})"
+  if isinstance(value, dict):
+    return f"dict({', '.join(sorted(f'{_canonical(k)}: {_canonical(v)}' for k, v in value.items()))})"
+  raise TypeError(f"Can't make a {{key}} from {value!r}, because it might not be the same in every job.  Use a function for outputfile instead.")
+
+def single_flight(outputfile, *, load=_pickleload, save=_pickledump, delay=1, maxiterations=None, **lockkwargs):
+  """
+  Decorator for a function whose result is expensive and is shared by many
+  jobs through a file.  The first job to call it computes the result under
+  a JobLock with the file as its output and saves it, other jobs calling it
+  at the same time wait for that, and later calls just load the file.
+
+  outputfile is either a function that takes the same arguments and returns
+  the filename, or a string that's formatted with the arguments by name,
+  plus {key}, a hash of all the arguments:
+
+    @single_flight("calibrations/{run}_{key}.pkl")
+    def calibration(run, **options):
+      ...
+
+  {key} only works for arguments made of numbers, strings, paths, None, and
+  lists, tuples, sets and dicts of those, so that every job gets the same key.
+
+  save(result, filename) and load(filename) use pickle by default.  The
+  result is saved to a temporary file that's renamed, so nobody ever loads
+  a partial file.  If the function fails, or the job computing it dies, the
+  lock and file are cleaned up as usual for JobLock and the next caller
+  computes it again.
+
+  The wait is a JobLockAndWait with adaptive=True, and lockkwargs are passed
+  to it.  Because the computation can take hours, by default the callers
+  wait for as long as it takes (while checking that the job computing it is
+  still running); pass maxiterations to give up after maxiterations * delay
+  seconds instead.
+  """
+  if maxiterations is None: maxiterations = float("inf")
+  def decorator(function):
+    signature = inspect.signature(function)
+    if not callable(outputfile) and "key" in signature.parameters:
+      raise TypeError(f"{function.__name__} has an argument called key, which clashes with {{key}} in outputfile.  Use a function for outputfile instead.")
+
+    def filename(*args, **kwargs):
+      if callable(outputfile):
+        return pathlib.Path(outputfile(*args, **kwargs))
+      bound = signature.bind(*args, **kwargs)
+      bound.apply_defaults()
+      key = hashlib.sha256(_canonical(dict(bound.arguments)).encode()).hexdigest()[:16]
+      return pathlib.Path(os.fspath(outputfile).format(key=key, **bound.arguments))
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+      path = filename(*args, **kwargs)
+      #fast path: somebody already computed it
+      if path.exists(): return load(path)
+      kwargs_ = {"silent": True, "task": f"computing {path}", **lockkwargs}
+      with JobLockAndWait(path.with_name(path.name + ".lock"), delay, outputfiles=[path], adaptive=True, maxiterations=maxiterations, **kwargs_) as lock:
+        if lock:
+          result = function(*args, **kwargs)
+          tmpfilename = path.with_name(f".{path.name}.{os.getpid()}")
+          try:
+            save(result, tmpfilename)
+            os.replace(tmpfilename, path)
+          finally:
+            rm_missing_ok(tmpfilename)
+          return result
+      return load(path)
+
+    wrapper.outputfile = filename
+    return wrapper
+  return decorator
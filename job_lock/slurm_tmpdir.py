@@ -1,7 +1,7 @@
-from .job_lock import JobLockAndWait, Slurm
-import contextlib, math, os, pathlib, shutil, subprocess
+from .job_lock import JobLock, JobLockAndWait, logger, rm_missing_ok, Slurm
+import atexit, collections, concurrent.futures, contextlib, errno, functools, hashlib, io, math, os, pathlib, shutil, subprocess, tempfile, threading
 
-def _rsync(source, dest, *, silent, copylinks, vvv=False):
+def _rsyncargs(*, silent, copylinks, vvv=False):
   args = ["-az", "--partial"]
   if copylinks: args.append("-L")
   if not silent:
@@ -10,9 +10,193 @@ def _rsync(source, dest, *, silent, copylinks, vvv=False):
     else:
       args.append("-v")
     args.append("--progress")
+  return args
+
+def _rsync(source, dest, *, silent, copylinks, vvv=False):
+  args = _rsyncargs(silent=silent, copylinks=copylinks, vvv=vvv)
   subprocess.check_call(["rsync", *args, os.fspath(source), os.fspath(dest)])
 
-def slurm_rsync_input(filename, *, tempfilename=None, copylinks=True, silentjoblock=None, silentrsync=None, vvv=False):
+class _CopyFileRange(object):
+  #copy_file_range can fail for some combinations of filesystems,
+  #in which case we stop trying it for the rest of the process
+  available = hasattr(os, "copy_file_range")
+  #same for sendfile, which needs a socket as the output on some platforms
+  sendfileavailable = hasattr(os, "sendfile")
+
+_copychunksize = 64 * 2**20
+_readbuffersize = 8 * 2**20
+
+def _copychunk(infd, outfd, offset, count):
+  """
+  Copy up to count bytes from position offset in infd to the same position in outfd.
+  The position of outfd has to already be at offset.
+  """
+  if _CopyFileRange.available:
+    try:
+      copied = os.copy_file_range(infd, outfd, count, offset, offset)
+    except OSError as e:
+      if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL, errno.EBADF): raise
+      _CopyFileRange.available = False
+    else:
+      os.lseek(outfd, offset + copied, os.SEEK_SET)
+      return copied
+  if _CopyFileRange.sendfileavailable:
+    try:
+      return os.sendfile(outfd, infd, offset, count)
+    except OSError as e:
+      if e.errno not in (errno.ENOSYS, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTSOCK): raise
+      _CopyFileRange.sendfileavailable = False
+  os.lseek(infd, offset, os.SEEK_SET)
+  data = os.read(infd, min(count, _readbuffersize))
+  written = 0
+  while written < len(data):
+    written += os.write(outfd, data[written:])
+  return len(data)
+
+def _copyrange(infd, outfd, offset, end, *, progress=None, stop=None):
+  os.lseek(outfd, offset, os.SEEK_SET)
+  while offset < end:
+    if stop is not None and stop.is_set(): break
+    copied = _copychunk(infd, outfd, offset, min(_copychunksize, end - offset))
+    if not copied: raise OSError(f"Source file ended after {offset} bytes, expected {end}")
+    offset += copied
+    if progress is not None: progress(offset)
+  return offset
+
+def _sha256(filename):
+  h = hashlib.sha256()
+  with open(filename, "rb") as f:
+    for chunk in iter(lambda: f.read(_readbuffersize), b""):
+      h.update(chunk)
+  return h.digest()
+
+class ChecksumMismatchError(Exception): pass
+
+def _partialfilename(dest):
+  return dest.with_name(f".{dest.name}.partial")
+
+def _partialstampfilename(dest):
+  return dest.with_name(f".{dest.name}.partial.source")
+
+def _openpartial(source, dest):
+  """
+  Open the partial copy of source for writing.
+  Returns the file descriptor and how many bytes of it are already copied.
+  A partial file left over from a previous attempt is reused only if
+  the source has the same size and mtime as when the copy was started.
+  """
+  partial = _partialfilename(dest)
+  stampfilename = _partialstampfilename(dest)
+  stamp = _sourcestamp(source)
+  try:
+    with open(stampfilename) as f:
+      resume = f.read() == stamp
+  except FileNotFoundError:
+    resume = False
+  fd = os.open(partial, os.O_WRONLY | os.O_CREAT, 0o666)
+  try:
+    offset = os.fstat(fd).st_size
+    if not resume or offset > int(stamp.split()[0]):
+      os.ftruncate(fd, 0)
+      offset = 0
+      with open(stampfilename, "w") as f:
+        f.write(stamp)
+  except BaseException:
+    os.close(fd)
+    raise
+  return fd, offset
+
+def _finishpartial(source, dest, *, checksum=False):
+  partial = _partialfilename(dest)
+  if checksum and _sha256(source) != _sha256(partial):
+    rm_missing_ok(partial)
+    rm_missing_ok(_partialstampfilename(dest))
+    raise ChecksumMismatchError(f"Checksum of {dest} doesn't match {source}")
+  shutil.copystat(source, partial)
+  os.replace(partial, dest)
+  rm_missing_ok(_partialstampfilename(dest))
+
+def _localcopy(source, dest, *, silent, copylinks, vvv=False, checksum=False):
+  """
+  Copy a regular file without starting a subprocess.
+  Like rsync --partial, an interrupted copy is resumed the next time,
+  and the file only appears at dest once it's complete.
+  """
+  source = pathlib.Path(source)
+  dest = pathlib.Path(dest)
+  if not silent: print(f"copying {source} to {dest}")
+  with open(source, "rb") as f:
+    fd, offset = _openpartial(source, dest)
+    try:
+      _copyrange(f.fileno(), fd, offset, os.fstat(f.fileno()).st_size)
+    finally:
+      os.close(fd)
+  _finishpartial(source, dest, checksum=checksum)
+
+copyengines = {
+  "rsync": _rsync,
+  "local": _localcopy,
+  "localchecksum": functools.partial(_localcopy, checksum=True),
+}
+
+def _copyengine(copyengine, source, *, copylinks):
+  if callable(copyengine): return copyengine
+  if copyengine is None:
+    #rsync is still used for anything other than a plain file,
+    #e.g. directories or symlinks that should stay symlinks
+    if source.is_file() and (copylinks or not source.is_symlink()):
+      copyengine = "local"
+    else:
+      copyengine = "rsync"
+  return copyengines[copyengine]
+
+def _stagedmarker(tempfilename):
+  return tempfilename.with_name(tempfilename.name + ".staged")
+
+def _sourcestamp(filename):
+  stat = filename.stat()
+  return f"{stat.st_size} {stat.st_mtime_ns}\n"
+
+def _isstaged(filename, tempfilename):
+  """
+  Check if tempfilename is a finished copy of the current version of filename,
+  without taking the lock.
+  """
+  try:
+    with open(_stagedmarker(tempfilename)) as f:
+      stamp = f.read()
+    if stamp != _sourcestamp(filename): return False
+    return tempfilename.stat().st_size == int(stamp.split()[0])
+  except (FileNotFoundError, ValueError):
+    return False
+
+def _markstaged(tempfilename, stamp):
+  marker = _stagedmarker(tempfilename)
+  tmpmarker = marker.with_name(f"{marker.name}.{os.getpid()}")
+  with open(tmpmarker, "w") as f:
+    f.write(stamp)
+  os.replace(tmpmarker, marker)
+
+@contextlib.contextmanager
+def _throttled(semaphore):
+  """
+  Hold a slot in semaphore (e.g. a JobSemaphoreAndWait), if one is given.
+  """
+  if semaphore is None:
+    yield
+    return
+  with semaphore as slot:
+    if not slot: raise RuntimeError(f"Couldn't get a slot in {semaphore.name}")
+    yield
+
+def _inputlockfilename(tempfilename):
+  lockfilename = tempfilename.with_suffix(".lock")
+  if lockfilename == tempfilename:
+    lockfilename = tempfilename.with_suffix(".lock_2")
+  assert lockfilename != tempfilename
+  return lockfilename
+
+def slurm_rsync_input(filename, *, tempfilename=None, copylinks=True, silentjoblock=None, silentrsync=None, vvv=False, copyengine=None, semaphore=None):
   filename = pathlib.Path(filename)
   if not filename.is_absolute(): raise ValueError(f"filename {filename} has to be an absolute path")
 
@@ -23,29 +207,196 @@ def slurm_rsync_input(filename, *, tempfilename=None, copylinks=True, silentjobl
   if Slurm.SLURM_JOBID() is not None:
     tmpdir = pathlib.Path(os.environ["TMPDIR"])
     tempfilename = tmpdir/tempfilename
+    if _isstaged(filename, tempfilename):
+      return tempfilename
     if silentrsync is None:
       silentrsync = tempfilename.exists()
     tempfilename.parent.mkdir(exist_ok=True, parents=True)
-    lockfilename = tempfilename.with_suffix(".lock")
-    if lockfilename == tempfilename:
-      lockfilename = tempfilename.with_suffix(".lock_2")
-    assert lockfilename != tempfilename
+    lockfilename = _inputlockfilename(tempfilename)
 
     filesize = filename.stat().st_size
     expected_time_upper_limit = 1.1 * filesize / JobLockAndWait.copyspeedlowerlimitbytespersecond
-    maxiterations = 1000
-    secondsperiteration = int(math.ceil(expected_time_upper_limit / maxiterations))
+    #poll every second to start with, backing off according to how long
+    #copies of this file have taken before, and give up after 1000 seconds
+    #or expected_time_upper_limit, whichever is longer
+    maxiterations = max(1000, int(math.ceil(expected_time_upper_limit)))
     try:
-      with JobLockAndWait(lockfilename, secondsperiteration, task=f"rsyncing {filename}", silent=silentjoblock, maxiterations=maxiterations):
-        _rsync(filename, tempfilename, silent=silentrsync, copylinks=copylinks, vvv=vvv)
-    except subprocess.CalledProcessError:
+      with JobLockAndWait(lockfilename, 1, task=f"rsyncing {filename}", silent=silentjoblock, maxiterations=maxiterations, adaptive=True):
+        #another job might have finished copying while we were waiting
+        if not _isstaged(filename, tempfilename):
+          stamp = _sourcestamp(filename)
+          rm_missing_ok(_stagedmarker(tempfilename))
+          copy = _copyengine(copyengine, filename, copylinks=copylinks)
+          with _throttled(semaphore):
+            copy(filename, tempfilename, silent=silentrsync, copylinks=copylinks, vvv=vvv)
+          _markstaged(tempfilename, stamp)
+    except (subprocess.CalledProcessError, OSError) as e:
+      logger.warning(f"Couldn't copy {filename} to {tempfilename}, reading it from its original location instead: {e}")
       return filename
     return tempfilename
   else:
     return filename
 
+class _BackgroundStager(threading.Thread):
+  """
+  Copies filename to tempfilename in a background thread,
+  keeping track of how much of it has been copied so far.
+  """
+  running = set()
+
+  def __init__(self, filename, tempfilename, lockfilename):
+    super().__init__(daemon=True)
+    self.filename = filename
+    self.tempfilename = tempfilename
+    self.lockfilename = lockfilename
+    self.copied = 0
+    self.stop = threading.Event()
+    self.error = None
+    self.__stagedfd = None
+    self.__readerclosed = False
+    self.__fdlock = threading.Lock()
+
+  def __setstagedfd(self, fd):
+    with self.__fdlock:
+      if self.__readerclosed:
+        os.close(fd)
+      else:
+        self.__stagedfd = fd
+
+  def stagedfd(self):
+    return self.__stagedfd
+
+  def closereader(self):
+    with self.__fdlock:
+      self.__readerclosed = True
+      if self.__stagedfd is not None:
+        os.close(self.__stagedfd)
+        self.__stagedfd = None
+
+  def __progress(self, copied):
+    self.copied = copied
+
+  def start(self):
+    self.running.add(self)
+    super().start()
+
+  def run(self):
+    try:
+      with JobLock(self.lockfilename) as lock:
+        #if someone else is copying, the reader just reads from the source
+        if not lock or _isstaged(self.filename, self.tempfilename): return
+        stamp = _sourcestamp(self.filename)
+        rm_missing_ok(_stagedmarker(self.tempfilename))
+        with open(self.filename, "rb") as f:
+          fd, offset = _openpartial(self.filename, self.tempfilename)
+          try:
+            self.__setstagedfd(os.open(_partialfilename(self.tempfilename), os.O_RDONLY))
+            self.copied = offset
+            end = _copyrange(f.fileno(), fd, offset, os.fstat(f.fileno()).st_size, progress=self.__progress, stop=self.stop)
+          finally:
+            os.close(fd)
+        if end == int(stamp.split()[0]) and not self.stop.is_set():
+          _finishpartial(self.filename, self.tempfilename)
+          _markstaged(self.tempfilename, stamp)
+    except Exception as e:
+      self.error = e
+    finally:
+      self.running.discard(self)
+
+  @classmethod
+  def stopall(cls):
+    #leave the partial file to be resumed later and release the lock
+    for stager in list(cls.running):
+      stager.stop.set()
+    for stager in list(cls.running):
+      stager.join()
+
+atexit.register(_BackgroundStager.stopall)
+
+class _ReadThroughFile(io.RawIOBase):
+  """
+  Reads the parts of the file that have already been staged from the
+  local copy, and the rest from the original file.
+  """
+  def __init__(self, filename, stager):
+    super().__init__()
+    self.name = os.fspath(filename)
+    self.__sourcefd = os.open(filename, os.O_RDONLY)
+    self.__stager = stager
+    self.__position = 0
+
+  def readable(self): return True
+  def seekable(self): return True
+
+  def readinto(self, b):
+    copied = self.__stager.copied
+    stagedfd = self.__stager.stagedfd()
+    if stagedfd is not None and self.__position < copied:
+      data = os.pread(stagedfd, min(len(b), copied - self.__position), self.__position)
+    else:
+      data = os.pread(self.__sourcefd, len(b), self.__position)
+    b[:len(data)] = data
+    self.__position += len(data)
+    return len(data)
+
+  def seek(self, offset, whence=io.SEEK_SET):
+    if whence == io.SEEK_SET:
+      position = offset
+    elif whence == io.SEEK_CUR:
+      position = self.__position + offset
+    elif whence == io.SEEK_END:
+      position = os.fstat(self.__sourcefd).st_size + offset
+    else:
+      raise ValueError(f"invalid whence ({whence})")
+    if position < 0: raise OSError(errno.EINVAL, f"negative seek position {position}")
+    self.__position = position
+    return position
+
+  def tell(self):
+    return self.__position
+
+  def close(self):
+    if not self.closed:
+      os.close(self.__sourcefd)
+      self.__stager.closereader()
+    super().close()
+
+def slurm_open_input(filename, mode="rb", *, tempfilename=None, encoding=None, buffersize=2**20):
+  """
+  Open an input file without waiting for it to be copied to $TMPDIR.
+  The copy continues in the background, and reads come from the
+  local copy once the part being read has been copied.
+  Later calls (and slurm_rsync_input) use the local copy once it's complete.
+  """
+  if mode not in ("r", "rb"): raise ValueError(f"Invalid mode {mode}, has to be r or rb")
+  filename = pathlib.Path(filename)
+  if not filename.is_absolute(): raise ValueError(f"filename {filename} has to be an absolute path")
+
+  if tempfilename is None: tempfilename = filename.relative_to("/")
+  tempfilename = pathlib.Path(tempfilename)
+  if tempfilename.is_absolute(): raise ValueError(f"tempfilename {tempfilename} has to be a relative path")
+
+  if Slurm.SLURM_JOBID() is None:
+    return open(filename, mode, encoding=encoding)
+
+  tmpdir = pathlib.Path(os.environ["TMPDIR"])
+  tempfilename = tmpdir/tempfilename
+  if _isstaged(filename, tempfilename):
+    return open(tempfilename, mode, encoding=encoding)
+  tempfilename.parent.mkdir(exist_ok=True, parents=True)
+
+  stager = _BackgroundStager(filename, tempfilename, _inputlockfilename(tempfilename))
+  f = io.BufferedReader(_ReadThroughFile(filename, stager), buffer_size=buffersize)
+  stager.start()
+  if mode == "r":
+    f = io.TextIOWrapper(f, encoding=encoding)
+  return f
+
+_PendingOutput = collections.namedtuple("_PendingOutput", ["tmpoutput", "filename", "tmpdir", "copylinks", "silentrsync", "ok_if_not_created", "vvv", "copyengine", "semaphore"])
+_pendingoutputs = []
+
 @contextlib.contextmanager
-def slurm_rsync_output(filename, *, tempfilename=None, copylinks=True, silentrsync=None, ok_if_not_created=False, vvv=False):
+def slurm_rsync_output(filename, *, tempfilename=None, copylinks=True, silentrsync=None, ok_if_not_created=False, vvv=False, copyengine=None, deferred=False, semaphore=None):
   filename = pathlib.Path(filename)
   if not filename.is_absolute(): raise ValueError(f"filename {filename} has to be an absolute path")
 
@@ -65,10 +416,139 @@ def slurm_rsync_output(filename, *, tempfilename=None, copylinks=True, silentrsy
         return
       else:
         raise FileNotFoundError(f"{tmpoutput} was not created in the with block")
-    _rsync(tmpoutput, filename, silent=silentrsync, copylinks=copylinks, vvv=vvv)
+    if deferred:
+      if not _pendingoutputs: atexit.register(slurm_flush_outputs)
+      _pendingoutputs.append(_PendingOutput(tmpoutput=tmpoutput, filename=filename, tmpdir=tmpdir, copylinks=copylinks, silentrsync=silentrsync, ok_if_not_created=ok_if_not_created, vvv=vvv, copyengine=copyengine, semaphore=semaphore))
+      return
+    copy = _copyengine(copyengine, tmpoutput, copylinks=copylinks)
+    with _throttled(semaphore):
+      copy(tmpoutput, filename, silent=silentrsync, copylinks=copylinks, vvv=vvv)
   else:
     yield filename
 
+def slurm_flush_outputs(*, maxworkers=None):
+  """
+  Copy the outputs from slurm_rsync_output(..., deferred=True) to their destinations.
+  Outputs that go through rsync are sent in one rsync call (per tmpdir and copylinks)
+  and the others are copied in parallel.  As with a single rsync, each file only
+  appears at its destination once it's complete.
+  If any of the outputs were given a semaphore, a slot in it is held for the
+  whole flush.
+  """
+  if not _pendingoutputs: return
+  atexit.unregister(slurm_flush_outputs)
+  pending = _pendingoutputs[:]
+  del _pendingoutputs[:]
+
+  semaphores = {id(_.semaphore): _.semaphore for _ in pending if _.semaphore is not None}
+  with contextlib.ExitStack() as stack:
+    #always take them in the same order so that jobs don't deadlock
+    for semaphore in sorted(semaphores.values(), key=lambda _: os.fspath(_.name)):
+      stack.enter_context(_throttled(semaphore))
+    _flushoutputs(pending, maxworkers=maxworkers)
+
+def _flushoutputs(pending, *, maxworkers):
+  errors = []
+  rsyncbatches = collections.defaultdict(list)
+  copies = []
+  for output in pending:
+    if not output.tmpoutput.exists():
+      if not output.ok_if_not_created:
+        errors.append(FileNotFoundError(f"{output.tmpoutput} was removed before it was copied to {output.filename}"))
+      continue
+    copy = _copyengine(output.copyengine, output.tmpoutput, copylinks=output.copylinks)
+    if copy is _rsync and output.tmpoutput == output.tmpdir/output.filename.relative_to("/"):
+      rsyncbatches[output.tmpdir, output.copylinks].append(output)
+    else:
+      copies.append((copy, output))
+
+  for (tmpdir, copylinks), outputs in rsyncbatches.items():
+    args = _rsyncargs(silent=all(_.silentrsync for _ in outputs), copylinks=copylinks, vvv=any(_.vvv for _ in outputs))
+    #-a doesn't imply -r with --files-from, and some of the outputs can be directories
+    args.append("-r")
+    with tempfile.NamedTemporaryFile("w", dir=tmpdir, prefix=".files-from") as f:
+      for output in outputs:
+        f.write(os.fspath(output.filename.relative_to("/")) + "\n")
+      f.flush()
+      try:
+        subprocess.check_call(["rsync", *args, f"--files-from={f.name}", os.fspath(tmpdir)+"/", "/"])
+      except (subprocess.CalledProcessError, OSError) as e:
+        errors.append(e)
+
+  def docopy(copyandoutput):
+    copy, output = copyandoutput
+    try:
+      copy(output.tmpoutput, output.filename, silent=output.silentrsync, copylinks=output.copylinks, vvv=output.vvv)
+    except (subprocess.CalledProcessError, OSError) as e:
+      return e
+  with concurrent.futures.ThreadPoolExecutor(max_workers=maxworkers) as executor:
+    errors += [e for e in executor.map(docopy, copies) if e is not None]
+
+  if len(errors) > 1:
+    #only one of them can be raised
+    for e in errors:
+      logger.error(f"Error when copying outputs: {e!r}")
+  if errors:
+    raise errors[0]
+
+def slurm_rank_by_locality(tasks, inputfiles):
+  """
+  Sort tasks so that the ones whose inputs are already staged in $TMPDIR,
+  by earlier slurm_rsync_input or slurm_open_input calls, come first.
+  inputfiles(task) gives a task's input files, as absolute paths.
+  The tasks are ranked by how many bytes of their input are already staged,
+  and then by how many bytes would have to be copied.
+  Returns a list of (task, staged bytes, bytes to copy).
+  Outside of a slurm job nothing is staged and the order is unchanged.
+  """
+  tasks = list(tasks)
+  if Slurm.SLURM_JOBID() is None:
+    return [(task, 0, 0) for task in tasks]
+  tmpdir = pathlib.Path(os.environ["TMPDIR"])
+
+  @functools.lru_cache(maxsize=None)
+  def stagedandsize(filename):
+    filename = pathlib.Path(filename)
+    try:
+      size = filename.stat().st_size
+    except FileNotFoundError:
+      return False, 0
+    return _isstaged(filename, tmpdir/filename.relative_to("/")), size
+
+  ranked = []
+  for task in tasks:
+    staged = tocopy = 0
+    for filename in inputfiles(task):
+      isstaged, size = stagedandsize(os.fspath(filename))
+      if isstaged:
+        staged += size
+      else:
+        tocopy += size
+    ranked.append((task, staged, tocopy))
+  ranked.sort(key=lambda _: (-_[1], _[2]))
+  return ranked
+
+@contextlib.contextmanager
+def slurm_locality_job_lock(tasks, *, inputfiles, lockfilename, outputfiles=None, **kwargs):
+  """
+  Try the JobLocks for tasks, in the order given by slurm_rank_by_locality,
+  and stop at the first one that succeeds.
+  lockfilename(task) and outputfiles(task) give the lock file and output files
+  for a task, and kwargs are passed to JobLock.
+  Yields (task, lock), or (None, None) if none of the locks succeeded.
+
+    with slurm_locality_job_lock(tasks, inputfiles=..., lockfilename=...) as (task, lock):
+      if lock:
+        ...
+  """
+  for task, staged, tocopy in slurm_rank_by_locality(tasks, inputfiles):
+    taskoutputfiles = [] if outputfiles is None else outputfiles(task)
+    with JobLock(lockfilename(task), inputfiles=inputfiles(task), outputfiles=taskoutputfiles, **kwargs) as lock:
+      if lock:
+        yield task, lock
+        return
+  yield None, None
+
 def slurm_clean_up_temp_dir():
   if Slurm.SLURM_JOBID() is None: return
   tmpdir = pathlib.Path(os.environ["TMPDIR"])
@@ -0,0 +1,200 @@
+import collections, contextlib, os, pathlib, random, sys, time
+from .job_lock import batchsubmissionsystems, jobfinished, jobinfo, JobLock, jobsfinished, logger, processstarttime, rm_missing_ok
+
+_Claim = collections.namedtuple("_Claim", ["state", "jobtype", "cpuid", "jobid", "starttime"])
+
+class TaskClaims(object):
+  """
+  Lets jobs claim tasks 0, 1, ..., ntasks-1 in batches, instead of having
+  one JobLock per task.  The tasks are split into shards of shardsize tasks,
+  and each shard has a claim file in folder with one line per claimed or done
+  task, saying which job claimed it.  Claiming a batch of tasks costs one
+  JobLock on the shard, one read, and one write.  Shards that have nothing
+  to claim are skipped after reading them, without taking their locks.
+
+  Claims held by jobs that finished without marking their tasks as done are
+  given to other jobs, with the same logic as stale JobLocks.
+
+  Keyword arguments are passed to the JobLocks on the shards.
+  """
+  CLAIMED = "claimed"
+  DONE = "done"
+
+  def __init__(self, folder, ntasks, *, shardsize=1000, delay=1, maxiterations=1000, **lockkwargs):
+    self.folder = pathlib.Path(folder)
+    self.ntasks = ntasks
+    self.shardsize = shardsize
+    self.delay = delay
+    self.maxiterations = maxiterations
+    self.__lockkwargs = lockkwargs
+
+  @property
+  def nshards(self):
+    return (self.ntasks + self.shardsize - 1) // self.shardsize
+
+  def shardfilename(self, shard):
+    return self.folder/f"claims_{shard}"
+
+  def shardtasks(self, shard):
+    return range(shard * self.shardsize, min((shard+1) * self.shardsize, self.ntasks))
+
+  def readshard(self, shard):
+    """
+    Returns {taskid: claim} for the claimed and done tasks in the shard.
+    """
+    claims = {}
+    try:
+      with open(self.shardfilename(shard)) as f:
+        for line in f:
+          try:
+            taskid, state, jobtype, cpuid, jobid, starttime = line.split()
+            claims[int(taskid)] = _Claim(state, jobtype, int(cpuid), int(jobid), None if starttime == "-" else float(starttime))
+          except ValueError:
+            logger.warning(f"Ignoring corrupt line in {self.shardfilename(shard)}: {line!r}")
+    except FileNotFoundError:
+      pass
+    return claims
+
+  def __writeshard(self, shard, claims):
+    filename = self.shardfilename(shard)
+    tmpfilename = filename.with_name(f".{filename.name}.{os.getpid()}")
+    try:
+      with open(tmpfilename, "w") as f:
+        for taskid, claim in sorted(claims.items()):
+          starttime = "-" if claim.starttime is None else repr(claim.starttime)
+          f.write(f"{taskid} {claim.state} {claim.jobtype} {claim.cpuid} {claim.jobid} {starttime}\n")
+      os.replace(tmpfilename, filename)
+    finally:
+      rm_missing_ok(tmpfilename)
+
+  @staticmethod
+  def __myclaim(state):
+    jobtype, cpuid, jobid = jobinfo()
+    starttime = processstarttime(jobid) if jobtype == sys.platform else None
+    return _Claim(state, jobtype, int(cpuid), int(jobid), starttime)
+
+  @staticmethod
+  def __ismine(claim, myclaim):
+    return claim[1:4] == myclaim[1:4]
+
+  def __staletasks(self, claims, myclaim):
+    tocheck = collections.defaultdict(dict)
+    for taskid, claim in claims.items():
+      if claim.state == self.CLAIMED and not self.__ismine(claim, myclaim):
+        tocheck[claim.jobtype][taskid] = claim
+    stale = []
+    for jobtype, jobclaims in tocheck.items():
+      dosqueue = self.__lockkwargs.get("dosqueue", True)
+      cachesqueue = self.__lockkwargs.get("cachesqueue", True)
+      if any(system.jobtype() == jobtype for system in batchsubmissionsystems):
+        finished = jobsfinished(jobtype, {(claim.cpuid, claim.jobid) for claim in jobclaims.values()}, dojoblist=dosqueue, cachejoblist=cachesqueue)
+        stale += [taskid for taskid, claim in jobclaims.items() if finished[claim.cpuid, claim.jobid]]
+      else:
+        stale += [taskid for taskid, claim in jobclaims.items() if jobfinished(jobtype, claim.cpuid, claim.jobid, starttime=claim.starttime)]
+    return stale
+
+  @contextlib.contextmanager
+  def __lockedshard(self, shard):
+    with JobLock(self.shardfilename(shard).with_suffix(".lock"), **self.__lockkwargs) as lock:
+      if not lock:
+        yield None
+        return
+      yield self.readshard(shard)
+
+  def __hasclaimabletasks(self, shard, myclaim):
+    #the claim files are replaced, not rewritten, so they can be read without the lock
+    claims = self.readshard(shard)
+    return len(claims) < len(self.shardtasks(shard)) or bool(self.__staletasks(claims, myclaim))
+
+  def claim(self, n=1):
+    """
+    Claim up to n tasks for this job and return their ids.
+    Returns fewer than n (possibly none) if there aren't enough
+    tasks left that aren't claimed or done.
+    """
+    claimed = []
+    myclaim = self.__myclaim(self.CLAIMED)
+    shards = list(range(self.nshards))
+    #start at different shards so that jobs don't all compete for the same one
+    random.shuffle(shards)
+    for iteration in range(self.maxiterations):
+      busy = []
+      for shard in shards:
+        if not self.__hasclaimabletasks(shard, myclaim): continue
+        with self.__lockedshard(shard) as claims:
+          if claims is None:
+            busy.append(shard)
+            continue
+          for taskid in self.__staletasks(claims, myclaim):
+            logger.info(f"Task {taskid} was claimed by a job that finished, reclaiming it")
+            del claims[taskid]
+          free = [taskid for taskid in self.shardtasks(shard) if taskid not in claims]
+          if not free: continue
+          for taskid in free[:n-len(claimed)]:
+            claims[taskid] = myclaim
+            claimed.append(taskid)
+          self.__writeshard(shard, claims)
+        if len(claimed) >= n: return claimed
+      if claimed or not busy: return claimed
+      shards = busy
+      time.sleep(self.delay * (1 + 0.1 * (random.random() - 0.5)))
+    raise RuntimeError(f"TaskClaims still could not get a shard lock after {self.maxiterations} iterations")
+
+  def __update(self, taskids, state):
+    myclaim = self.__myclaim(state)
+    byshard = collections.defaultdict(list)
+    for taskid in taskids:
+      byshard[taskid // self.shardsize].append(taskid)
+    for shard, shardtaskids in byshard.items():
+      for iteration in range(self.maxiterations):
+        with self.__lockedshard(shard) as claims:
+          if claims is not None:
+            for taskid in shardtaskids:
+              claim = claims.get(taskid)
+              if claim is None or not self.__ismine(claim, myclaim):
+                raise ValueError(f"Task {taskid} isn't claimed by this job")
+              if state is None:
+                del claims[taskid]
+              else:
+                claims[taskid] = claim._replace(state=state)
+            self.__writeshard(shard, claims)
+            break
+        time.sleep(self.delay * (1 + 0.1 * (random.random() - 0.5)))
+      else:
+        raise RuntimeError(f"TaskClaims still could not get the lock for shard {shard} after {self.maxiterations} iterations")
+
+  def done(self, taskids):
+    """
+    Mark tasks claimed by this job as done, so that nobody claims them again.
+    """
+    self.__update(taskids, self.DONE)
+
+  def release(self, taskids):
+    """
+    Give up the claims on tasks, so that other jobs can claim them.
+    """
+    self.__update(taskids, None)
+
+  @contextlib.contextmanager
+  def claimed(self, n=1):
+    """
+    Claim up to n tasks.  If the with block finishes successfully, they
+    are marked as done, and otherwise they're released.
+    """
+    taskids = self.claim(n)
+    try:
+      yield taskids
+    except BaseException:
+      if taskids: self.release(taskids)
+      raise
+    if taskids: self.done(taskids)
+
+  def counts(self):
+    """
+    Number of tasks that are claimed, done, and neither.
+    """
+    result = collections.Counter()
+    for shard in range(self.nshards):
+      result.update(claim.state for claim in self.readshard(shard).values())
+    result["unclaimed"] = self.ntasks - result[self.CLAIMED] - result[self.DONE]
+    return result
@@ -0,0 +1,182 @@
+import atexit, collections, json, logging, os, pathlib, threading, time
+from .job_lock import _hostname, jobinfo, settracer
+
+logger = logging.getLogger("JobLock")
+
+class LockTracer(object):
+  """
+  Writes one json line per lock event to filename.  The events are
+    attempt:  JobLock tried to acquire the lock (outcome says what happened)
+    reclaim:  the lock was left behind by a job that died and was removed
+    release:  the lock was released after being held for `held` seconds
+    wait:     JobLockAndWait is sleeping for `duration` seconds
+    waitdone: JobLockAndWait is done waiting, after `duration` seconds
+  The lines are buffered and written every buffersize events or
+  flushinterval seconds, whichever comes first, and when the job exits.
+  """
+  def __init__(self, filename, *, buffersize=1000, flushinterval=10):
+    self.filename = pathlib.Path(filename)
+    self.buffersize = buffersize
+    self.flushinterval = flushinterval
+    self.job = " ".join(str(_) for _ in jobinfo())
+    self.host = _hostname()
+    self.__buffer = []
+    self.__lastflush = time.monotonic()
+    self.__lock = threading.Lock()
+
+  def event(self, event, lockfilename, **fields):
+    record = {"t": time.time(), "event": event, "lock": os.fspath(lockfilename), "job": self.job, "host": self.host}
+    record.update(fields)
+    line = json.dumps(record) + "\n"
+    with self.__lock:
+      self.__buffer.append(line)
+      if len(self.__buffer) >= self.buffersize or time.monotonic() - self.__lastflush >= self.flushinterval:
+        self.__flush()
+
+  def flush(self):
+    with self.__lock:
+      self.__flush()
+
+  def __flush(self):
+    lines = "".join(self.__buffer)
+    del self.__buffer[:]
+    self.__lastflush = time.monotonic()
+    if not lines: return
+    try:
+      with open(self.filename, "a") as f:
+        f.write(lines)
+    except (IOError, OSError) as e:
+      #tracing should never make the job fail
+      logger.warning(f"Couldn't write lock trace to {self.filename}: {e}")
+
+_tracer = None
+
+def enable_tracing(folder, **kwargs):
+  """
+  Trace every lock event in this process to a file in folder,
+  named after the job.  kwargs are passed to LockTracer.
+  """
+  global _tracer
+  disable_tracing()
+  folder = pathlib.Path(folder)
+  folder.mkdir(parents=True, exist_ok=True)
+  jobtype, cpuid, jobid = jobinfo()
+  _tracer = LockTracer(folder/f"{jobtype}_{cpuid}_{jobid}_{os.getpid()}.jsonl", **kwargs)
+  atexit.register(_tracer.flush)
+  settracer(_tracer)
+  return _tracer
+
+def disable_tracing():
+  global _tracer
+  if _tracer is None: return
+  settracer(None)
+  atexit.unregister(_tracer.flush)
+  _tracer.flush()
+  _tracer = None
+
+def read_traces(*paths):
+  """
+  Read the events from trace files, or folders of trace files,
+  merged in time order.  Lines that can't be parsed (e.g. from a
+  job that was killed in the middle of writing) are skipped.
+  """
+  records = []
+  for path in paths:
+    path = pathlib.Path(path)
+    filenames = sorted(path.glob("*.jsonl")) if path.is_dir() else [path]
+    for filename in filenames:
+      with open(filename) as f:
+        for line in f:
+          try:
+            record = json.loads(line)
+          except ValueError:
+            continue
+          if isinstance(record, dict) and "t" in record and "event" in record and "lock" in record:
+            records.append(record)
+  records.sort(key=lambda record: record["t"])
+  return records
+
+def _percentile(sortedvalues, percentile):
+  if not sortedvalues: return None
+  index = max(int(round(percentile / 100 * len(sortedvalues))) - 1, 0)
+  return sortedvalues[min(index, len(sortedvalues)-1)]
+
+def analyze_traces(records, *, timelinebin=60):
+  """
+  Summarize trace records from read_traces:
+    locks:    per lock file, sorted with the most contended first
+    waits:    distribution of the total time spent in JobLockAndWait
+    timeline: number of events and time spent waiting in each timelinebin seconds
+  """
+  locks = collections.defaultdict(lambda: {"attempts": 0, "acquired": 0, "contended": 0, "reclaims": 0, "waittime": 0., "holdtime": 0., "maxholdtime": 0., "releases": 0, "jobs": set()})
+  waits = []
+  timeline = collections.defaultdict(lambda: {"attempts": 0, "acquired": 0, "contended": 0, "reclaims": 0, "waittime": 0.})
+
+  for record in records:
+    lock = locks[record["lock"]]
+    lock["jobs"].add(record.get("job"))
+    bucket = timeline[int(record["t"] // timelinebin * timelinebin)]
+    event = record["event"]
+    if event == "attempt":
+      lock["attempts"] += 1
+      bucket["attempts"] += 1
+      if record.get("outcome") == "acquired":
+        lock["acquired"] += 1
+        bucket["acquired"] += 1
+      elif record.get("outcome") == "held":
+        lock["contended"] += 1
+        bucket["contended"] += 1
+    elif event == "reclaim":
+      lock["reclaims"] += 1
+      bucket["reclaims"] += 1
+    elif event == "release":
+      lock["releases"] += 1
+      lock["holdtime"] += record.get("held", 0)
+      lock["maxholdtime"] = max(lock["maxholdtime"], record.get("held", 0))
+    elif event == "wait":
+      lock["waittime"] += record.get("duration", 0)
+      bucket["waittime"] += record.get("duration", 0)
+    elif event == "waitdone":
+      waits.append(record.get("duration", 0))
+
+  lockresults = []
+  for filename, lock in locks.items():
+    lock = dict(lock)
+    lock["lock"] = filename
+    lock["jobs"] = len(lock["jobs"])
+    lock["meanholdtime"] = lock["holdtime"] / lock["releases"] if lock["releases"] else None
+    lockresults.append(lock)
+  lockresults.sort(key=lambda lock: (-lock["waittime"], -lock["contended"], lock["lock"]))
+
+  waits.sort()
+  waitresults = {
+    "count": len(waits),
+    "total": sum(waits),
+    **{f"p{_}": _percentile(waits, _) for _ in (50, 90, 99)},
+    "max": waits[-1] if waits else None,
+  }
+
+  timelineresults = [dict(start=start, **bucket) for start, bucket in sorted(timeline.items())]
+  return {"locks": lockresults, "waits": waitresults, "timeline": timelineresults}
+
+def print_trace_report(analysis, *, top=20, timeline=False):
+  def fmt(seconds):
+    return "-" if seconds is None else f"{seconds:.3g}s"
+
+  print(f"Most contended locks (top {top}):")
+  print(f"  {'wait':>10} {'contended':>9} {'attempts':>8} {'reclaims':>8} {'mean hold':>10} {'max hold':>10} {'jobs':>5}  lock")
+  for lock in analysis["locks"][:top]:
+    print(f"  {fmt(lock['waittime']):>10} {lock['contended']:>9} {lock['attempts']:>8} {lock['reclaims']:>8} {fmt(lock['meanholdtime']):>10} {fmt(lock['maxholdtime']):>10} {lock['jobs']:>5}  {lock['lock']}")
+
+  waits = analysis["waits"]
+  print()
+  print(f"Time spent in JobLockAndWait ({waits['count']} calls, {fmt(waits['total'])} total):")
+  print(f"  p50 {fmt(waits['p50'])}  p90 {fmt(waits['p90'])}  p99 {fmt(waits['p99'])}  max {fmt(waits['max'])}")
+
+  if timeline:
+    print()
+    print("Timeline:")
+    print(f"  {'start':>19} {'attempts':>8} {'acquired':>8} {'contended':>9} {'reclaims':>8} {'wait':>10}")
+    for bucket in analysis["timeline"]:
+      start = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(bucket["start"]))
+      print(f"  {start:>19} {bucket['attempts']:>8} {bucket['acquired']:>8} {bucket['contended']:>9} {bucket['reclaims']:>8} {fmt(bucket['waittime']):>10}")
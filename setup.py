@@ -17,6 +17,7 @@ setuptools.setup(
   entry_points = {
     "console_scripts": [
       "clean_up_old_job_locks=job_lock.job_lock:clean_up_old_job_locks_argparse",
+      "job_lock=job_lock.commandline:main",
     ],
   },
   long_description = long_description,
@@ -1,9 +1,24 @@
-import argparse, contextlib, datetime, logging, multiprocessing, os, pathlib, subprocess, sys, tempfile, time, unittest
-from job_lock import add_job_lock_arguments, clean_up_old_job_locks, clear_running_jobs_cache, jobfinished, JobLock, JobLockAndWait, jobinfo, MultiJobLock, process_job_lock_arguments, setsqueueoutput, slurm_clean_up_temp_dir, slurm_rsync_input, slurm_rsync_output
-from job_lock.job_lock import clean_up_old_job_locks_argparse
+import argparse, collections, concurrent.futures, contextlib, datetime, io, json, logging, multiprocessing, os, pathlib, shutil, signal, subprocess, sys, tempfile, threading, time, unittest, unittest.mock
+from job_lock import add_job_lock_arguments, analyze_traces, clean_up_old_job_locks, clear_running_jobs_cache, CompletionManifest, disable_tracing, enable_tracing, install_preemption_handler, jobfinished, JobLock, JobLockAndWait, JobLockExecutor, JobLockProbe, jobinfo, JobSemaphore, JobSemaphoreAndWait, jobsfinished, lock_inventory, LockNamespace, MultiJobLock, process_job_lock_arguments, publish_job_list, read_traces, reap_stale_locks, run_reaper, setsqueueoutput, single_flight, Skipped, slurm_clean_up_temp_dir, slurm_flush_outputs, slurm_locality_job_lock, slurm_open_input, slurm_rank_by_locality, slurm_rsync_input, slurm_rsync_output, TaskClaims, uninstall_preemption_handler
+from job_lock.job_lock import BatchSubmissionSystem, clean_up_old_job_locks_argparse, processstarttime, setcondorqoutput
+from job_lock.slurm_tmpdir import ChecksumMismatchError
+import job_lock.commandline
 
 logger = logging.getLogger("JobLock")
 
+#counts of the events from sys.addaudithook while testFastPath is measuring them
+auditevents = None
+def audithook(event, args):
+  if auditevents is not None: auditevents[event] += 1
+
+def writeoutput(filename, text):
+  #module level so that it can be pickled for JobLockExecutor
+  with open(filename, "w") as f:
+    f.write(text)
+  if text == "fail":
+    raise ValueError(text)
+  return text
+
 class TestJobLock(unittest.TestCase, contextlib.ExitStack):
   loglevel = logging.CRITICAL
 
@@ -147,6 +162,47 @@ class TestJobLock(unittest.TestCase, contextlib.ExitStack):
     self.assertFalse(output1.exists())
     self.assertFalse(output2.exists())
 
+  def testCompletionManifest(self):
+    fn1 = self.tmpdir/"lock1.lock"
+    output1 = self.tmpdir/"outputfile1.txt"
+    output2 = self.tmpdir/"outputfile2.txt"
+
+    manifest = CompletionManifest(self.tmpdir)
+    with JobLock(fn1, outputfiles=[output1, output2], completionmanifest=manifest) as lock:
+      self.assertTrue(lock)
+      output1.touch()
+    with JobLock(fn1, outputfiles=[output1, output2], completionmanifest=manifest) as lock:
+      self.assertTrue(lock)
+      self.assertEqual(lock.outputsexist, {output1: True, output2: False})
+      output2.touch()
+
+    #the manifest is trusted, so deleting the file isn't noticed
+    output1.unlink()
+    manifest = CompletionManifest(self.tmpdir)
+    with JobLock(fn1, outputfiles=[output1, output2], completionmanifest=manifest) as lock:
+      self.assertFalse(lock)
+      self.assertEqual(lock.outputsexist, {output1: True, output2: True})
+    with JobLock(fn1, outputfiles=[output1, output2], completionmanifest=CompletionManifest(self.tmpdir, verify=True)) as lock:
+      self.assertTrue(lock)
+      self.assertEqual(lock.outputsexist, {output1: False, output2: True})
+
+    #a partially written manifest is suspect, so the files are stat'ed
+    with open(manifest.filename, "a") as f: f.write("123 ")
+    manifest = CompletionManifest(self.tmpdir)
+    self.assertTrue(manifest.suspect)
+    self.assertEqual(manifest.outputsexist([output1, output2]), {output1: False, output2: True})
+
+    self.assertTrue(manifest.compact())
+    self.assertFalse(manifest.suspect)
+    with open(manifest.filename) as f:
+      self.assertEqual([line.split()[-1] for line in f], [os.fspath(output2)])
+
+    #verify=True notices an output that was rewritten after it was recorded
+    self.assertEqual(CompletionManifest(self.tmpdir, verify=True).outputsexist([output2]), {output2: True})
+    with open(output2, "w") as f: f.write("truncated")
+    self.assertEqual(CompletionManifest(self.tmpdir, verify=True).outputsexist([output2]), {output2: False})
+    self.assertEqual(CompletionManifest(self.tmpdir).outputsexist([output2]), {output2: True})
+
   def testPrevStepLockFiles(self):
     fn1 = self.tmpdir/"lock1.lock"
     fn2 = self.tmpdir/"lock2.lock"
@@ -185,6 +241,48 @@ class TestJobLock(unittest.TestCase, contextlib.ExitStack):
       self.assertTrue(lock)
       self.assertEqual(lock.debuginfo, {"outputsexist": None, "inputsexist": None, "prevsteplockfilesexist": {fn1: False}, "oldjobinfo": None, "removed_failed_job": False, "iterative_lock_debuginfo": None})
 
+  def testJobLockProbe(self):
+    dummysqueue = f"""
+      #!/bin/bash
+      echo "$@" >> {self.tmpdir/"squeuecalls"}
+      echo '
+           1234567   RUNNING
+      '
+    """.lstrip()
+    with open(self.tmpdir/"squeue", "w") as f:
+      f.write(dummysqueue)
+    (self.tmpdir/"squeue").chmod(0o777)
+
+    with open(self.tmpdir/"lock2.lock", "w") as f:
+      f.write("SLURM 0 1234567")
+    with open(self.tmpdir/"lock3.lock", "w") as f:
+      f.write("SLURM 0 1234568")
+    with open(self.tmpdir/"lock4.lock", "w") as f:
+      f.write("SLURM 0 1234569")
+    with open(self.tmpdir/"lock5.lock", "w") as f:
+      f.write("corrupt")
+
+    filenames = [self.tmpdir/f"lock{i}.lock" for i in range(1, 7)]
+    with JobLock(filenames[5]):
+      statuses = JobLockProbe().statuses(filenames)
+      self.assertEqual(statuses, {
+        filenames[0]: "free",
+        filenames[1]: "held",
+        filenames[2]: "stale",
+        filenames[3]: "stale",
+        filenames[4]: "held",
+        filenames[5]: "held",
+      })
+    #one squeue call for all the jobs
+    with open(self.tmpdir/"squeuecalls") as f:
+      self.assertEqual(f.read().split(), ["--job", "1234567,1234568,1234569", "--Format", "jobid,state", "--noheader"])
+    #probing doesn't touch the locks
+    self.assertEqual(sorted(self.tmpdir.glob("lock*")), filenames[1:5])
+
+    time.sleep(0.1)
+    self.assertEqual(JobLockProbe(corruptfiletimeout=datetime.timedelta(seconds=0.1)).status(filenames[4]), "stale")
+    self.assertEqual(JobLockProbe(minimumtimeforiterativelocks=datetime.timedelta(seconds=10)).status(filenames[2]), "held")
+
   def testRunningJobs(self):
     jobtype, cpuid, jobid = jobinfo()
     with open(self.tmpdir/"lock1.lock", "w") as f:
@@ -211,6 +309,26 @@ class TestJobLock(unittest.TestCase, contextlib.ExitStack):
     with JobLock(self.tmpdir/"lock4.lock") as lock4:
       self.assertTrue(lock4)
 
+  @unittest.skipIf(sys.platform == "cygwin", "process start times aren't recorded on cygwin")
+  def testPidReuse(self):
+    jobtype, cpuid, jobid = jobinfo()
+    with subprocess.Popen(["cat"], stdin=subprocess.PIPE, stdout=subprocess.PIPE) as popen:
+      pid = popen.pid
+      starttime = processstarttime(pid)
+      with open(self.tmpdir/"lock1.lock", "w") as f:
+        f.write(f"{jobtype} {cpuid} {pid}\nhostname\nstarttime {starttime!r}\n")
+      with open(self.tmpdir/"lock2.lock", "w") as f:
+        f.write(f"{jobtype} {cpuid} {pid}\nhostname\nstarttime {starttime-1000!r}\n")
+      with JobLock(self.tmpdir/"lock1.lock") as lock1:
+        self.assertFalse(lock1)
+      with JobLock(self.tmpdir/"lock2.lock") as lock2:
+        #same pid, but a different process
+        self.assertTrue(lock2)
+
+    with JobLock(self.tmpdir/"lock3.lock") as lock3:
+      self.assertTrue(lock3)
+      self.assertEqual(lock3.runningjobstarttime(), processstarttime(os.getpid()))
+
   def testsqueue(self):
     dummysqueue = """
       #!/bin/bash
@@ -238,13 +356,15 @@ class TestJobLock(unittest.TestCase, contextlib.ExitStack):
       self.assertTrue(lock3)
 
   def testcondor(self):
-    dummycondor_q = """
+    dummycondor_q = f"""
       #!/bin/bash
+      echo "$@" > {self.tmpdir/"condor_q_args"}
       echo '
-        -- Schedd: my schedd
-         ID      OWNER            SUBMITTED     RUN_TIME ST PRI SIZE CMD
-         1234567.1
-         1234568.1
+         1234567 1 2
+         1234568 1 2
+         1234569 0 1
+         1234570 0 5
+         1234571 0 4
       '
     """.lstrip()
     with open(self.tmpdir/"condor_q", "w") as f:
@@ -261,17 +381,53 @@ class TestJobLock(unittest.TestCase, contextlib.ExitStack):
       f.write("CONDOR 1234568 1")
     with open(self.tmpdir/"lock5.lock", "w") as f:
       f.write("CONDOR 1234567 2")
+    with open(self.tmpdir/"lock6.lock", "w") as f:
+      f.write("CONDOR 1234569 0")
+    with open(self.tmpdir/"lock7.lock", "w") as f:
+      f.write("CONDOR 1234570 0")
+    with open(self.tmpdir/"lock8.lock", "w") as f:
+      f.write("CONDOR 1234571 0")
 
     with JobLock(self.tmpdir/"lock1.lock") as lock1:
       self.assertFalse(lock1)
     with JobLock(self.tmpdir/"lock2.lock") as lock2:
       self.assertFalse(lock2)
+    with open(self.tmpdir/"condor_q_args") as f:
+      self.assertEqual(f.read(), "-af ClusterId ProcId JobStatus -constraint ClusterId == 1234567\n")
     with JobLock(self.tmpdir/"lock3.lock") as lock3:
       self.assertTrue(lock3)
     with JobLock(self.tmpdir/"lock4.lock") as lock4:
       self.assertFalse(lock4)
     with JobLock(self.tmpdir/"lock5.lock") as lock5:
       self.assertTrue(lock5)
+    with JobLock(self.tmpdir/"lock6.lock") as lock6:
+      #idle
+      self.assertTrue(lock6)
+    with JobLock(self.tmpdir/"lock7.lock") as lock7:
+      #held
+      self.assertTrue(lock7)
+    with JobLock(self.tmpdir/"lock8.lock") as lock8:
+      #completed
+      self.assertTrue(lock8)
+
+    self.assertEqual(
+      jobsfinished("CONDOR", [(1234568, 1), (1234569, 0), (1234572, 0)], cachejoblist=False),
+      {(1234568, 1): False, (1234569, 0): True, (1234572, 0): True},
+    )
+    with open(self.tmpdir/"condor_q_args") as f:
+      self.assertEqual(f.read(), "-af ClusterId ProcId JobStatus -constraint ClusterId == 1234568 || ClusterId == 1234569 || ClusterId == 1234572\n")
+
+    #the old condor_q -nobatch output can still be provided
+    setcondorqoutput(output="""
+      -- Schedd: my schedd
+       ID      OWNER            SUBMITTED     RUN_TIME ST PRI SIZE CMD
+       1234567.1
+       1234568.1
+    """)
+    self.callback(setcondorqoutput)
+    self.assertFalse(jobfinished("CONDOR", 1234567, 1, cachejoblist=False))
+    self.assertTrue(jobfinished("CONDOR", 1234567, 0, cachejoblist=False))
+    self.assertIsNone(jobfinished("CONDOR", 1234569, 0, cachejoblist=False))
 
   def testCacheSqueue(self):
     with open(self.tmpdir/"lock.lock", "w") as f:
@@ -356,6 +512,317 @@ class TestJobLock(unittest.TestCase, contextlib.ExitStack):
       self.assertGreaterEqual(lock3.niterations, 3)
       self.assertLessEqual(lock3.niterations, 4)
 
+  def testFairJobLockAndWait(self):
+    lockfilename = self.tmpdir/"lock1.lock"
+    with JobLockAndWait(lockfilename, 0.001, silent=True, fair=True) as lock:
+      self.assertTrue(lock)
+      self.assertEqual(lock.niterations, 1)
+      #nobody else is in line, so the counter is removed too
+      self.assertEqual(list(self.tmpdir.glob("lock1.lock.ticket*")), [])
+
+    #a ticket left behind by a process that died doesn't hold up the line
+    with open(self.tmpdir/"lock1.lock.ticket_1", "w") as f:
+      jobtype, cpuid, _ = jobinfo()
+      f.write(f"{jobtype} {cpuid} 999999999\n")
+    with open(self.tmpdir/"lock1.lock.ticket", "w") as f:
+      f.write("2\n")
+    with JobLockAndWait(lockfilename, 0.001, silent=True, fair=True) as lock:
+      self.assertTrue(lock)
+      self.assertEqual(lock.niterations, 1)
+    self.assertFalse((self.tmpdir/"lock1.lock.ticket_1").exists())
+
+    #a live job ahead of us in line gets to go first even though the lock is free
+    with JobLock(self.tmpdir/"lock1.lock.ticket_3") as ticket:
+      self.assertTrue(ticket)
+      with open(self.tmpdir/"lock1.lock.ticket", "w") as f:
+        f.write("4\n")
+      with self.assertRaises(RuntimeError):
+        with JobLockAndWait(lockfilename, 0.001, silent=True, fair=True, maxiterations=3):
+          pass
+      self.assertFalse(lockfilename.exists())
+      self.assertEqual(list(self.tmpdir.glob("lock1.lock.ticket_*")), [self.tmpdir/"lock1.lock.ticket_3"])
+      self.assertTrue((self.tmpdir/"lock1.lock.ticket").exists())
+    with JobLockAndWait(lockfilename, 0.001, silent=True, fair=True) as lock:
+      self.assertTrue(lock)
+    self.assertEqual(list(self.tmpdir.glob("lock1.lock.ticket*")), [])
+
+    #someone who comes in right after we take a number sees our ticket
+    #and waits behind it, instead of resetting the counter and going first
+    exit = JobLockAndWait.__exit__
+    cutinline = []
+    def exitandcutinline(self, *args):
+      result = exit(self, *args)
+      if self.filename.name == "lock1.lock.ticket.lock" and not cutinline:
+        cutinline.append("took a number")
+        try:
+          with JobLockAndWait(lockfilename, 0.001, silent=True, fair=True, maxiterations=3):
+            cutinline.append("went first")
+        except RuntimeError:
+          cutinline.append("waited")
+      return result
+    with unittest.mock.patch.object(JobLockAndWait, "__exit__", autospec=True, side_effect=exitandcutinline):
+      with JobLockAndWait(lockfilename, 0.001, silent=True, fair=True) as lock:
+        self.assertTrue(lock)
+    self.assertEqual(cutinline, ["took a number", "waited"])
+    self.assertEqual(list(self.tmpdir.glob("lock1.lock.ticket*")), [])
+
+  def testAdaptiveJobLockAndWait(self):
+    lockfilename = self.tmpdir/"lock1.lock"
+    with JobLockAndWait(lockfilename, 0.001, silent=True, adaptive=True) as lock:
+      self.assertTrue(lock)
+      self.assertIsNone(lock.readholdtime())
+      time.sleep(0.1)
+    holdtime = lock.readholdtime()
+    self.assertGreaterEqual(holdtime, 0.1)
+    self.assertLess(holdtime, 1)
+
+    with JobLockAndWait(lockfilename, 0.001, silent=True, adaptive=True) as lock:
+      pass
+    self.assertLess(lock.readholdtime(), holdtime)
+    self.assertGreater(lock.readholdtime(), holdtime * (1 - JobLockAndWait.holdtimeweight))
+
+    #maxiterations * delay is a deadline
+    with JobLock(lockfilename) as lock:
+      self.assertTrue(lock)
+      start = time.monotonic()
+      with self.assertRaises(RuntimeError):
+        with JobLockAndWait(lockfilename, 0.01, silent=True, adaptive=True, maxiterations=20):
+          pass
+      elapsed = time.monotonic() - start
+      self.assertGreaterEqual(elapsed, 0.2)
+      self.assertLess(elapsed, 1)
+
+  def testJobSemaphore(self):
+    name = self.tmpdir/"semaphore"
+    with JobSemaphore(name, 2) as s1, JobSemaphore(name, 2) as s2, JobSemaphore(name, 2) as s3:
+      self.assertTrue(s1)
+      self.assertTrue(s2)
+      self.assertFalse(s3)
+      self.assertEqual({s1.slot, s2.slot}, {0, 1})
+    self.assertEqual(list(self.tmpdir.glob("semaphore.slot_*")), [])
+
+    #slots held by jobs that died are reclaimed
+    jobtype, cpuid, _ = jobinfo()
+    for filename in JobSemaphore(name, 2).slotfilenames:
+      with open(filename, "w") as f:
+        f.write(f"{jobtype} {cpuid} 999999999\n")
+    with JobSemaphore(name, 2, minimumtimeforiterativelocks=None) as s1, JobSemaphore(name, 2, minimumtimeforiterativelocks=None) as s2:
+      self.assertTrue(s1)
+      self.assertTrue(s2)
+
+    with JobSemaphore(name, 1) as s1:
+      self.assertTrue(s1)
+      with self.assertRaises(RuntimeError):
+        with JobSemaphoreAndWait(name, 1, 0.001, maxiterations=3, silent=True):
+          pass
+
+      inputfile = self.tmpdir/"input.txt"
+      with open(inputfile, "w") as f: f.write("hello")
+      os.environ["SLURM_JOBID"] = "1234567"
+      with self.assertRaises(RuntimeError):
+        slurm_rsync_input(inputfile, silentrsync=True, semaphore=JobSemaphoreAndWait(name, 1, 0.001, maxiterations=3, silent=True))
+    rsyncedinput = slurm_rsync_input(inputfile, silentrsync=True, semaphore=JobSemaphoreAndWait(name, 1, 0.001, maxiterations=3, silent=True))
+    with open(rsyncedinput) as f:
+      self.assertEqual(f.read(), "hello")
+    self.assertEqual(list(self.tmpdir.glob("semaphore.slot_*")), [])
+
+  def testThreads(self):
+    lockfilename = self.tmpdir/"lock1.lock"
+    acquired = threading.Event()
+    release = threading.Event()
+    def holdlock():
+      with JobLock(lockfilename) as lock:
+        self.assertTrue(lock)
+        acquired.set()
+        release.wait()
+    thread = threading.Thread(target=holdlock)
+    thread.start()
+    self.callback(thread.join)
+    self.callback(release.set)
+    acquired.wait()
+
+    #another thread gets the answer without reading the lock file
+    with JobLock(lockfilename) as lock:
+      self.assertFalse(lock)
+      self.assertIsNone(lock.oldjobinfo)
+
+    #and waits for the lock to be released instead of sleeping for the whole delay
+    threading.Timer(0.1, release.set).start()
+    start = time.monotonic()
+    with JobLockAndWait(lockfilename, 10, silent=True) as lock:
+      self.assertTrue(lock)
+      self.assertLess(time.monotonic() - start, 5)
+      #not reentrant
+      with JobLock(lockfilename) as lock2:
+        self.assertFalse(lock2)
+        self.assertEqual(lock2.oldjobinfo, jobinfo())
+      self.assertTrue(lockfilename.exists())
+    self.assertFalse(lockfilename.exists())
+
+    #only one thread at a time in the with block
+    inside = []
+    maxinside = []
+    def work():
+      for i in range(5):
+        with JobLockAndWait(lockfilename, 0.01, silent=True, maxiterations=10000) as lock:
+          self.assertTrue(lock)
+          inside.append(None)
+          maxinside.append(len(inside))
+          time.sleep(0.001)
+          inside.pop()
+    threads = [threading.Thread(target=work) for _ in range(8)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    self.assertEqual(len(maxinside), 40)
+    self.assertEqual(max(maxinside), 1)
+
+  def testTaskClaims(self):
+    folder = self.tmpdir/"claims"
+    folder.mkdir()
+    claims = TaskClaims(folder, 25, shardsize=10, delay=0.001)
+    self.assertEqual(claims.nshards, 3)
+    first = claims.claim(12)
+    self.assertEqual(len(first), 12)
+    self.assertEqual(len(set(first)), 12)
+    #only the shard files are left, no locks
+    self.assertEqual(sorted(_.name for _ in folder.iterdir()), sorted(f"claims_{_}" for _ in {_ // 10 for _ in first}))
+    claims.done(first[:5])
+    claims.release(first[5:])
+    self.assertEqual(claims.counts(), {"done": 5, "unclaimed": 20})
+    with self.assertRaises(ValueError):
+      claims.done(first[5:6])
+
+    #claims by other jobs: one that finished, and one that's still running
+    jobtype, cpuid, _ = jobinfo()
+    shard = first[5] // 10
+    others = [_ for _ in claims.shardtasks(shard) if _ not in first[:5]]
+    with open(claims.shardfilename(shard), "a") as f:
+      f.write(f"{others[0]} claimed {jobtype} {cpuid} 999999999 -\n")
+      f.write(f"{others[1]} claimed SLURM 0 1234567 -\n")
+    self.assertEqual(claims.counts(), {"done": 5, "claimed": 2, "unclaimed": 18})
+
+    with self.assertRaises(ZeroDivisionError):
+      with claims.claimed(100) as taskids:
+        self.assertEqual(len(taskids), 19)
+        self.assertIn(others[0], taskids)
+        self.assertNotIn(others[1], taskids)
+        1/0
+    self.assertEqual(claims.counts(), {"done": 5, "claimed": 1, "unclaimed": 19})
+
+    with claims.claimed(100) as taskids:
+      self.assertEqual(len(taskids), 19)
+    self.assertEqual(claims.counts(), {"done": 24, "claimed": 1, "unclaimed": 0})
+    self.assertEqual(claims.claim(), [])
+
+    #shards with nothing to claim are skipped without taking their locks,
+    #and this job's identity is only looked up once
+    claims = TaskClaims(self.tmpdir/"claims2", 100, shardsize=10, delay=0.001, mkdir=True)
+    self.assertEqual(len(claims.claim(99)), 99)
+    with unittest.mock.patch("job_lock.task_claims.JobLock", wraps=JobLock) as joblock, unittest.mock.patch("job_lock.task_claims.processstarttime", wraps=processstarttime) as starttime:
+      self.assertEqual(len(claims.claim(5)), 1)
+      self.assertEqual(claims.claim(), [])
+    self.assertEqual(joblock.call_count, 1)
+    self.assertLessEqual(starttime.call_count, 2)
+
+  def testJobLockExecutor(self):
+    for usethreads in True, False:
+      with self.subTest(usethreads=usethreads):
+        folder = self.tmpdir/f"executor_{usethreads}"
+        folder.mkdir()
+        (folder/"1.out").write_text("already done")
+        texts = ["0", "done", "2", "held", "fail"] + [str(_) for _ in range(5, 20)]
+        with JobLock(folder/"3.lock") as heldlock, JobLockExecutor(2, usethreads=usethreads) as executor:
+          self.assertTrue(heldlock)
+          futures = [executor.submit(folder/f"{i}.lock", writeoutput, folder/f"{i}.out", text, outputfiles=[folder/f"{i}.out"]) for i, text in enumerate(texts)]
+          self.assertEqual(futures[0].result(), "0")
+          self.assertIsInstance(futures[1].result(), Skipped)
+          self.assertEqual(futures[1].result().reason, "outputsexist")
+          self.assertEqual(futures[3].result().reason, "held")
+          with self.assertRaises(ValueError):
+            futures[4].result()
+          self.assertEqual([_.result() for _ in futures[5:]], texts[5:])
+        #the failed task's output was removed, and all the locks were released
+        self.assertEqual(sorted(_.name for _ in folder.iterdir()), sorted(f"{i}.out" for i in range(20) if i not in (3, 4)))
+        with self.assertRaises(RuntimeError):
+          executor.submit(folder/"0.lock", writeoutput, folder/"0.out", "0")
+
+    with JobLockExecutor(usethreads=True) as executor:
+      self.assertEqual(executor.maxinflight, 2 * (os.cpu_count() or 1))
+      #it doesn't pretend to have Executor.map, which wouldn't know the lock filenames
+      self.assertNotIsInstance(executor, concurrent.futures.Executor)
+      self.assertFalse(hasattr(executor, "map"))
+
+  def testSingleFlight(self):
+    folder = self.tmpdir/"cache"
+    folder.mkdir()
+    calls = []
+    @single_flight(os.fspath(folder/"square_{x}_{key}.pkl"), delay=0.01)
+    def square(x, fail=False):
+      calls.append(x)
+      time.sleep(0.1)
+      if fail: raise ValueError(x)
+      return x**2
+
+    #computed once, while the other threads wait for it
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(square(3))) for _ in range(4)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    self.assertEqual(results, [9]*4)
+    self.assertEqual(calls, [3])
+    #later calls load the file
+    self.assertEqual(square(3), 9)
+    self.assertEqual(calls, [3])
+    self.assertEqual(square.outputfile(3).parent, folder)
+    self.assertNotEqual(square.outputfile(3), square.outputfile(4))
+    self.assertNotEqual(square.outputfile(3), square.outputfile(3, fail=True))
+
+    #a failure leaves nothing behind, and the next call tries again
+    with self.assertRaises(ValueError):
+      square(4, fail=True)
+    self.assertEqual(sorted(_.name for _ in folder.iterdir() if _.suffix != ".holdtime"), [square.outputfile(3).name])
+    self.assertEqual(square(4), 16)
+    self.assertEqual(calls, [3, 4, 4])
+
+    #{key} doesn't depend on the order of keyword arguments or dicts
+    @single_flight(os.fspath(folder/"options_{key}.pkl"))
+    def options(run, **kwargs):
+      return kwargs
+    self.assertEqual(options.outputfile(1, a=1, b={"x": 1, "y": {2, 3}}), options.outputfile(1, b={"y": {3, 2}, "x": 1}, a=1))
+    self.assertNotEqual(options.outputfile(1, a=1), options.outputfile(1, a=2))
+    #but it can't be made from arguments whose repr isn't the same in every job
+    with self.assertRaises(TypeError):
+      options.outputfile(1, a=object())
+    #and an argument called key would clash with it
+    with self.assertRaises(TypeError):
+      @single_flight(os.fspath(folder/"{key}.pkl"))
+      def haskey(key):
+        pass
+
+  @unittest.skipIf(sys.version_info < (3, 8), "needs sys.addaudithook")
+  def testFastPath(self):
+    global auditevents
+    #importing job_lock doesn't import the submodules or psutil
+    output = subprocess.check_output([sys.executable, "-c", "import job_lock, sys; print(sorted(_ for _ in sys.modules if _.startswith('job_lock') or _ == 'psutil'))"])
+    self.assertEqual(output.decode().strip(), "['job_lock']")
+
+    if not getattr(TestJobLock, "audithookinstalled", False):
+      sys.addaudithook(audithook)
+      TestJobLock.audithookinstalled = True
+    lockfilename = self.tmpdir/"lock1.lock"
+    with JobLock(lockfilename) as lock:
+      self.assertTrue(lock)
+    counted = "open", "os.remove", "os.rename", "os.mkdir", "os.scandir", "os.listdir", "pathlib.Path.glob", "socket.gethostname", "subprocess.Popen"
+    auditevents = collections.Counter()
+    try:
+      with JobLock(lockfilename) as lock:
+        self.assertTrue(lock)
+    finally:
+      events, auditevents = auditevents, None
+    #create the lock file, write to it, and remove it: nothing else
+    self.assertEqual({_: events[_] for _ in counted if events[_]}, {"open": 2, "os.remove": 1})
+    self.assertFalse(lockfilename.exists())
+
   def testTimeout(self):
     with JobLock(self.tmpdir/"lock1.lock", outputfiles=[self.tmpdir/"output.txt"]) as lock:
       self.assertTrue(lock)
@@ -433,6 +900,13 @@ class TestJobLock(unittest.TestCase, contextlib.ExitStack):
     self.assertFalse(fn2.exists())
     self.assertFalse(fn3.exists())
 
+    #a stale second iterative lock is cleaned up even if nobody else wanted the lock
+    with open(fn3, "w") as f: f.write("SLURM 0 1234567")
+    time.sleep(1)
+    with JobLock(fn1, minimumtimeforiterativelocks=datetime.timedelta(seconds=1)) as lock:
+      self.assertTrue(lock)
+    self.assertFalse(fn3.exists())
+
   def testCleanUp(self):
     with open(self.tmpdir/"lock1.lock_2", "w"): pass
     with open(self.tmpdir/"lock1.lock_5", "w"): pass
@@ -458,6 +932,242 @@ class TestJobLock(unittest.TestCase, contextlib.ExitStack):
     self.assertFalse((self.tmpdir/"lock1.lock_10").exists())
     self.assertFalse((self.tmpdir/"lock1.lock_30").exists())
 
+  def testLockNamespace(self):
+    root = self.tmpdir/"locks"
+    namespace = LockNamespace(root)
+    lockfilename = namespace.lockfilename(self.tmpdir/"output.lock")
+    self.assertEqual(lockfilename, namespace.lockfilename(self.tmpdir/"output.lock"))
+    self.assertNotEqual(lockfilename, namespace.lockfilename(self.tmpdir/"subfolder"/"output.lock"))
+    self.assertEqual(lockfilename.relative_to(root).parts[:2], (lockfilename.name[:2], lockfilename.name[2:4]))
+    self.assertTrue(lockfilename.name.endswith("_output.lock"))
+    self.assertEqual(LockNamespace().lockfilename(self.tmpdir/"output.lock").relative_to(self.tmpdir).parts[0], ".job_locks")
+
+    with JobLock(self.tmpdir/"output.lock", namespace=namespace) as lock:
+      self.assertTrue(lock)
+      self.assertEqual(lock.filename, lockfilename)
+      self.assertTrue(lockfilename.exists())
+      self.assertFalse((self.tmpdir/"output.lock").exists())
+      with self.assertRaises(RuntimeError):
+        with JobLockAndWait(self.tmpdir/"output.lock", 0.001, maxiterations=3, silent=True, namespace=namespace, fair=True):
+          pass
+      with MultiJobLock(self.tmpdir/"output.lock", self.tmpdir/"output2.lock", namespace=namespace) as lock3:
+        self.assertFalse(lock3)
+      with JobLock(self.tmpdir/"output3.lock", prevsteplockfiles=[self.tmpdir/"output.lock"], namespace=namespace) as lock4:
+        self.assertFalse(lock4)
+    self.assertFalse(lockfilename.exists())
+    with JobSemaphore(self.tmpdir/"semaphore", 2, namespace=namespace) as s:
+      self.assertTrue(s)
+      self.assertTrue(namespace.lockfilename(self.tmpdir/f"semaphore.slot_{s.slot}").exists())
+
+    iterativelock = lockfilename.with_suffix(".lock_2")
+    with open(iterativelock, "w"): pass
+    time.sleep(1)
+    clean_up_old_job_locks(root, howold=datetime.timedelta(seconds=1), silent=True, maxworkers=4)
+    self.assertFalse(iterativelock.exists())
+
+  def testStatus(self):
+    jobtype, cpuid, myjobid = jobinfo()
+    (self.tmpdir/"subfolder").mkdir()
+    with open(self.tmpdir/"stale.lock", "w") as f:
+      f.write(f"{jobtype} {cpuid} 999999999\n")
+    with open(self.tmpdir/"subfolder"/"corrupt.lock", "w") as f:
+      f.write("not a lock\n")
+    with open(self.tmpdir/"orphan.lock_2", "w") as f:
+      f.write(f"{jobtype} {cpuid} 999999999\n")
+    with open(self.tmpdir/"slurm.lock", "w") as f:
+      f.write("SLURM 0 1234567\n")
+    with open(self.tmpdir/"slurm2.lock", "w") as f:
+      f.write("SLURM 0 1234568\n")
+    with open(self.tmpdir/"notalock.txt", "w") as f:
+      f.write(f"{jobtype} {cpuid} 999999999\n")
+
+    dummysqueue = f"""
+      #!/bin/bash
+      echo "$@" >> {self.tmpdir/"squeueargs"}
+      echo '
+           1234567   RUNNING
+      '
+    """.lstrip()
+    with open(self.tmpdir/"squeue", "w") as f:
+      f.write(dummysqueue)
+    (self.tmpdir/"squeue").chmod(0o777)
+
+    with contextlib.ExitStack() as stack:
+      stack.enter_context(JobLock(self.tmpdir/"subfolder"/"held.lock"))
+      #list all the jobs instead of passing them on the command line
+      stack.callback(setattr, BatchSubmissionSystem, "maxjobsperjoblistcommand", BatchSubmissionSystem.maxjobsperjoblistcommand)
+      BatchSubmissionSystem.maxjobsperjoblistcommand = 1
+      inventory = {lock.filename.relative_to(self.tmpdir): lock for lock in lock_inventory(self.tmpdir, maxworkers=4)}
+
+      self.assertEqual({filename: lock.status for filename, lock in inventory.items()}, {
+        pathlib.Path("stale.lock"): "stale",
+        pathlib.Path("subfolder")/"corrupt.lock": "corrupt",
+        pathlib.Path("orphan.lock_2"): "orphaned",
+        pathlib.Path("slurm.lock"): "held",
+        pathlib.Path("slurm2.lock"): "stale",
+        pathlib.Path("subfolder")/"held.lock": "held",
+      })
+      self.assertEqual(inventory[pathlib.Path("subfolder")/"held.lock"].jobid, myjobid)
+      self.assertTrue(inventory[pathlib.Path("orphan.lock_2")].reclaimable)
+      with open(self.tmpdir/"squeueargs") as f:
+        self.assertEqual(f.read(), "--Format jobid,state --noheader\n")
+
+      clear_running_jobs_cache()
+      stdout = io.StringIO()
+      with contextlib.redirect_stdout(stdout):
+        job_lock.commandline.main(["status", os.fspath(self.tmpdir), "--json", "--only", "stale", "--only", "held"])
+      result = json.loads(stdout.getvalue())
+      self.assertEqual(result["summary"], {"stale": 2, "held": 2})
+      self.assertEqual(sorted(_["filename"] for _ in result["locks"]), sorted(os.fspath(self.tmpdir/_) for _ in ("stale.lock", "slurm.lock", "slurm2.lock", "subfolder/held.lock")))
+
+      #locks with other names, like for clean_up_old_job_locks
+      self.assertEqual([(lock.filename, lock.status) for lock in lock_inventory(self.tmpdir, glob="*.txt")], [(self.tmpdir/"notalock.txt", "stale")])
+      stdout = io.StringIO()
+      with contextlib.redirect_stdout(stdout):
+        job_lock.commandline.main(["status", os.fspath(self.tmpdir), "--json", "--glob", "*.txt"])
+      self.assertEqual(json.loads(stdout.getvalue())["summary"]["stale"], 1)
+      self.assertEqual(reap_stale_locks(self.tmpdir, glob="*.txt", dryrun=True), [self.tmpdir/"notalock.txt"])
+      stdout = io.StringIO()
+      with contextlib.redirect_stdout(stdout):
+        job_lock.commandline.main(["reap", os.fspath(self.tmpdir), "--glob", "*.txt"])
+      self.assertEqual(stdout.getvalue(), f"Removed {self.tmpdir/'notalock.txt'}\n")
+      self.assertFalse((self.tmpdir/"notalock.txt").exists())
+
+  def testTracing(self):
+    tracedir = self.tmpdir/"traces"
+    enable_tracing(tracedir)
+    self.callback(disable_tracing)
+
+    lockfilename = self.tmpdir/"lock1.lock"
+    with JobLock(lockfilename) as lock:
+      self.assertTrue(lock)
+      with JobLock(lockfilename) as lock2:
+        self.assertFalse(lock2)
+      with self.assertRaises(RuntimeError):
+        with JobLockAndWait(lockfilename, 0.001, maxiterations=2, silent=True):
+          pass
+    jobtype, cpuid, _ = jobinfo()
+    with open(self.tmpdir/"lock2.lock", "w") as f:
+      f.write(f"{jobtype} {cpuid} 999999999\n")
+    with JobLock(self.tmpdir/"lock2.lock") as lock:
+      self.assertTrue(lock)
+      self.assertTrue(lock.removed_failed_job)
+    self.assertEqual(list(tracedir.iterdir()), []) #buffered
+    disable_tracing()
+
+    records = read_traces(tracedir)
+    self.assertEqual(
+      [(record["event"], pathlib.Path(record["lock"]).name, record.get("outcome")) for record in records if not record["lock"].endswith(".lock_2")],
+      [
+        ("attempt", "lock1.lock", "acquired"),
+        ("attempt", "lock1.lock", "held"),
+        ("attempt", "lock1.lock", "held"),
+        ("wait", "lock1.lock", None),
+        ("attempt", "lock1.lock", "held"),
+        ("wait", "lock1.lock", None),
+        ("waitdone", "lock1.lock", "held"),
+        ("release", "lock1.lock", None),
+        ("attempt", "lock2.lock", "acquired"),
+        ("reclaim", "lock2.lock", None),
+        ("release", "lock2.lock", None),
+      ]
+    )
+    self.assertEqual({record["job"] for record in records}, {" ".join(str(_) for _ in jobinfo())})
+    #the same host as in the lock files
+    with JobLock(lockfilename):
+      with open(lockfilename) as f:
+        host = f.read().split("\n")[1]
+    self.assertEqual({record["host"] for record in records}, {host})
+
+    analysis = analyze_traces(records)
+    locks = {pathlib.Path(lock["lock"]).name: lock for lock in analysis["locks"]}
+    self.assertEqual(locks["lock1.lock"]["contended"], 3)
+    self.assertEqual(locks["lock1.lock"]["releases"], 1)
+    self.assertEqual(locks["lock2.lock"]["reclaims"], 1)
+    self.assertEqual(analysis["locks"][0]["lock"], os.fspath(lockfilename))
+    self.assertEqual(analysis["waits"]["count"], 1)
+
+    stdout = io.StringIO()
+    with contextlib.redirect_stdout(stdout):
+      job_lock.commandline.main(["trace-report", os.fspath(tracedir), "--timeline"])
+      job_lock.commandline.main(["trace-report", os.fspath(tracedir), "--json"])
+    self.assertIn(os.fspath(lockfilename), stdout.getvalue())
+
+  def testReaper(self):
+    outputfile = self.tmpdir/"output.txt"
+    with JobLock(self.tmpdir/"lock1.lock", outputfiles=[outputfile]) as lock:
+      self.assertEqual(lock.runningjoboutputfiles(), [outputfile])
+
+    def makelock(filename, jobid, outputfiles=[]):
+      with open(filename, "w") as f:
+        f.write(f"SLURM 0 {jobid}\nhostname\n")
+        for _ in outputfiles:
+          f.write(f"outputfile {_}\n")
+          _.touch()
+    makelock(self.tmpdir/"running.lock", 1234567, [self.tmpdir/"running.txt"])
+    makelock(self.tmpdir/"finished.lock", 1234568, [self.tmpdir/"finished.txt", self.tmpdir/"finished2.txt"])
+    makelock(self.tmpdir/"pending.lock", 1234569)
+    #submitted after squeue was run
+    makelock(self.tmpdir/"new.lock", 1234570, [self.tmpdir/"new.txt"])
+
+    dummysqueue = f"""
+      #!/bin/bash
+      echo "$@" >> {self.tmpdir/"squeueargs"}
+      echo '
+           1234567   RUNNING
+           1234569   PENDING
+      '
+    """.lstrip()
+    with open(self.tmpdir/"squeue", "w") as f:
+      f.write(dummysqueue)
+    (self.tmpdir/"squeue").chmod(0o777)
+
+    self.assertEqual(reap_stale_locks(self.tmpdir, dryrun=True), [self.tmpdir/"finished.lock"])
+    self.assertTrue((self.tmpdir/"finished.lock").exists())
+    self.assertTrue((self.tmpdir/"finished.txt").exists())
+
+    stdout = io.StringIO()
+    with contextlib.redirect_stdout(stdout):
+      job_lock.commandline.main(["reap", os.fspath(self.tmpdir)])
+    self.assertEqual(stdout.getvalue(), f"Removed {self.tmpdir/'finished.lock'}\n")
+    for filename in "running.lock", "running.txt", "pending.lock", "new.lock", "new.txt":
+      self.assertTrue((self.tmpdir/filename).exists(), filename)
+    for filename in "finished.lock", "finished.txt", "finished2.txt":
+      self.assertFalse((self.tmpdir/filename).exists(), filename)
+    with open(self.tmpdir/"squeueargs") as f:
+      self.assertEqual(f.read(), "--Format jobid,state --noheader\n" * 2)
+
+    #the squeue output isn't used after the reaper is done
+    self.assertIsNone(jobfinished("SLURM", 0, 1234570, dojoblist=False))
+    #and whatever was set before is used again
+    setsqueueoutput(output="1234570 RUNNING\n")
+    reap_stale_locks(self.tmpdir, dryrun=True)
+    self.assertFalse(jobfinished("SLURM", 0, 1234570, dojoblist=False))
+    setsqueueoutput()
+
+    run_reaper(self.tmpdir, interval=0.01, cycles=3, silent=True)
+    with open(self.tmpdir/"squeueargs") as f:
+      self.assertEqual(f.read(), "--Format jobid,state --noheader\n" * 6)
+
+    #a lock whose folder disappears after the scan doesn't stop the others from being reaped
+    (self.tmpdir/"gone").mkdir()
+    makelock(self.tmpdir/"gone"/"finished.lock", 1234568)
+    makelock(self.tmpdir/"finished.lock", 1234568)
+    def inventoryandremove(*args, **kwargs):
+      inventory = lock_inventory(*args, **kwargs)
+      shutil.rmtree(self.tmpdir/"gone")
+      return inventory
+    with unittest.mock.patch("job_lock.reaper.lock_inventory", inventoryandremove):
+      self.assertEqual(reap_stale_locks(self.tmpdir), [self.tmpdir/"finished.lock"])
+
+    #and a cycle that fails doesn't stop the reaper
+    with unittest.mock.patch("job_lock.reaper.reap_stale_locks", side_effect=[OSError("failed"), []]) as reap:
+      run_reaper(self.tmpdir, interval=0.01, cycles=2, silent=True)
+    self.assertEqual(reap.call_count, 2)
+    with unittest.mock.patch("job_lock.reaper.reap_stale_locks", side_effect=OSError("failed")):
+      with self.assertRaises(OSError):
+        run_reaper(self.tmpdir, silent=True)
+
   def testMkdir(self):
     with self.assertRaises(FileNotFoundError):
       with JobLock(self.tmpdir/"nested"/"subfolders"/"lock1.lock") as lock:
@@ -488,6 +1198,147 @@ class TestJobLock(unittest.TestCase, contextlib.ExitStack):
       self.assertEqual(f1.read(), "hello")
       self.assertEqual(f2.read(), "hello 2")
 
+  def testSlurmRsyncInputAlreadyStaged(self):
+    def fakersync(script):
+      with open(self.tmpdir/"rsync", "w") as f:
+        f.write(f"#!/bin/bash\necho run >> {self.tmpdir/'rsynccalls'}\n{script}\n")
+      (self.tmpdir/"rsync").chmod(0o777)
+    def nrsynccalls():
+      with open(self.tmpdir/"rsynccalls") as f:
+        return len(f.read().split())
+
+    inputfile = self.tmpdir/"input.txt"
+    with open(inputfile, "w") as f: f.write("hello")
+    os.environ["SLURM_JOBID"] = "1234567"
+
+    fakersync('cp "${@: -2:1}" "${@: -1}"')
+    rsyncedinput = slurm_rsync_input(inputfile, silentrsync=True, copyengine="rsync")
+    self.assertNotEqual(inputfile, rsyncedinput)
+    self.assertEqual(nrsynccalls(), 1)
+
+    #already staged, so neither the lock nor rsync are needed
+    fakersync("exit 1")
+    with JobLock(rsyncedinput.with_suffix(".lock")):
+      self.assertEqual(slurm_rsync_input(inputfile, silentrsync=True, copyengine="rsync"), rsyncedinput)
+    self.assertEqual(nrsynccalls(), 1)
+
+    #the input changed, so it has to be copied again
+    with open(inputfile, "w") as f: f.write("hello again")
+    self.assertEqual(slurm_rsync_input(inputfile, silentrsync=True, copyengine="rsync"), inputfile)
+    self.assertEqual(nrsynccalls(), 2)
+    fakersync('cp "${@: -2:1}" "${@: -1}"')
+    self.assertEqual(slurm_rsync_input(inputfile, silentrsync=True, copyengine="rsync"), rsyncedinput)
+    self.assertEqual(nrsynccalls(), 3)
+    with open(rsyncedinput) as f:
+      self.assertEqual(f.read(), "hello again")
+
+  def testLocalCopy(self):
+    inputfile = self.tmpdir/"input.txt"
+    contents = os.urandom(3*2**20)
+    with open(inputfile, "wb") as f: f.write(contents)
+    os.environ["SLURM_JOBID"] = "1234567"
+    stagedfile = self.slurm_tmpdir/inputfile.relative_to("/")
+
+    #leftover partial copy from an interrupted job
+    partial = stagedfile.with_name(f".{stagedfile.name}.partial")
+    partial.parent.mkdir(parents=True)
+    with open(partial, "wb") as f: f.write(contents[:2**20])
+    #recording which version of the input it's a copy of
+    partialsource = stagedfile.with_name(f".{stagedfile.name}.partial.source")
+    with open(partialsource, "w") as f: f.write(f"{inputfile.stat().st_size} {inputfile.stat().st_mtime_ns}\n")
+
+    self.assertEqual(slurm_rsync_input(inputfile, silentrsync=True, copyengine="localchecksum"), stagedfile)
+    with open(stagedfile, "rb") as f:
+      self.assertEqual(f.read(), contents)
+    self.assertFalse(partial.exists())
+    self.assertFalse(partialsource.exists())
+    self.assertEqual(stagedfile.stat().st_mtime_ns, inputfile.stat().st_mtime_ns)
+
+    #a partial copy of an older version of the input isn't reused,
+    #even if the input was rewritten in place after the copy started
+    with open(partial, "wb") as f: f.write(b"x" * 2**20)
+    with open(partialsource, "w") as f: f.write(f"{inputfile.stat().st_size} {inputfile.stat().st_mtime_ns}\n")
+    newcontents = os.urandom(len(contents))
+    with open(inputfile, "r+b") as f: f.write(newcontents)
+    os.utime(inputfile, ns=(inputfile.stat().st_mtime_ns + 10**9,)*2)
+    self.assertEqual(slurm_rsync_input(inputfile, silentrsync=True), stagedfile)
+    with open(stagedfile, "rb") as f:
+      self.assertEqual(f.read(), newcontents)
+
+    #a checksum mismatch is an error, not a reason to quietly read the original
+    with open(inputfile, "ab") as f: f.write(b"more")
+    with unittest.mock.patch("job_lock.slurm_tmpdir._sha256", side_effect=[b"a", b"b"]), self.assertRaises(ChecksumMismatchError):
+      slurm_rsync_input(inputfile, silentrsync=True, copyengine="localchecksum")
+    self.assertFalse(partial.exists())
+
+    #other failures fall back to the original, with a warning
+    with open(self.tmpdir/"rsync", "w") as f: f.write("#!/bin/bash\nexit 1\n")
+    (self.tmpdir/"rsync").chmod(0o777)
+    with self.assertLogs(logger, logging.WARNING):
+      self.assertEqual(slurm_rsync_input(inputfile, silentrsync=True, copyengine="rsync"), inputfile)
+
+  def testLocality(self):
+    inputs = {}
+    for name, size in ("small", 10), ("medium", 100), ("big", 1000):
+      inputs[name] = self.tmpdir/f"{name}.txt"
+      with open(inputs[name], "w") as f: f.write("x" * size)
+    tasks = {"A": ["big"], "B": ["small"], "C": ["medium", "small"]}
+    inputfiles = lambda task: [inputs[_] for _ in tasks[task]]
+    lockfilename = lambda task: self.tmpdir/f"{task}.lock"
+
+    self.assertEqual(slurm_rank_by_locality("ABC", inputfiles), [("A", 0, 0), ("B", 0, 0), ("C", 0, 0)])
+
+    os.environ["SLURM_JOBID"] = "1234567"
+    self.assertEqual(slurm_rank_by_locality("ABC", inputfiles), [("B", 0, 10), ("C", 0, 110), ("A", 0, 1000)])
+    slurm_rsync_input(inputs["medium"], silentrsync=True)
+    self.assertEqual(slurm_rank_by_locality("ABC", inputfiles), [("C", 100, 10), ("B", 0, 10), ("A", 0, 1000)])
+    #a staged copy of an older version doesn't count
+    with open(inputs["medium"], "a") as f: f.write("x")
+    self.assertEqual(slurm_rank_by_locality("ABC", inputfiles), [("B", 0, 10), ("C", 0, 111), ("A", 0, 1000)])
+    slurm_rsync_input(inputs["medium"], silentrsync=True)
+
+    with JobLock(lockfilename("C")):
+      with slurm_locality_job_lock("ABC", inputfiles=inputfiles, lockfilename=lockfilename) as (task, lock):
+        self.assertEqual(task, "B")
+        self.assertTrue(lock)
+        with slurm_locality_job_lock("ABC", inputfiles=inputfiles, lockfilename=lockfilename) as (task2, lock2):
+          self.assertEqual(task2, "A")
+          with slurm_locality_job_lock("ABC", inputfiles=inputfiles, lockfilename=lockfilename) as (task3, lock3):
+            self.assertIsNone(task3)
+            self.assertIsNone(lock3)
+
+  def testSlurmOpenInput(self):
+    inputfile = self.tmpdir/"input.txt"
+    contents = os.urandom(20*2**20)
+    with open(inputfile, "wb") as f: f.write(contents)
+
+    with slurm_open_input(inputfile) as f:
+      self.assertEqual(f.name, os.fspath(inputfile))
+
+    os.environ["SLURM_JOBID"] = "1234567"
+    with slurm_open_input(inputfile, buffersize=2**16) as f:
+      self.assertEqual(f.read(100), contents[:100])
+      f.seek(-100, os.SEEK_END)
+      self.assertEqual(f.read(), contents[-100:])
+      f.seek(2**20)
+      self.assertEqual(f.read(), contents[2**20:])
+
+    #wait for the background copy to finish
+    stagedinput = slurm_rsync_input(inputfile, silentjoblock=True, silentrsync=True)
+    self.assertNotEqual(stagedinput, inputfile)
+    with open(stagedinput, "rb") as f:
+      self.assertEqual(f.read(), contents)
+    with slurm_open_input(inputfile) as f:
+      self.assertEqual(f.name, os.fspath(stagedinput))
+      self.assertEqual(f.read(), contents)
+
+    with open(inputfile, "w") as f: f.write("hello\nworld\n")
+    with slurm_open_input(inputfile, "r") as f:
+      self.assertEqual(f.readlines(), ["hello\n", "world\n"])
+    #the file changed, so it's copied again in the background: wait for that
+    #too, so that it's not still writing when the folder is removed
+    slurm_rsync_input(inputfile, silentjoblock=True, silentrsync=True)
+
   def testSlurmRsyncOutput(self):
     outputfile = self.tmpdir/"output.txt"
     with slurm_rsync_output(outputfile, silentrsync=True) as outputtorsync:
@@ -510,6 +1361,110 @@ class TestJobLock(unittest.TestCase, contextlib.ExitStack):
       self.assertEqual(f1.read(), "hello")
       self.assertEqual(f2.read(), "hello 2")
 
+  def testDeferredOutput(self):
+    os.environ["SLURM_JOBID"] = "1234567"
+    outputfiles = [self.tmpdir/f"output{i}.txt" for i in range(5)]
+    for i, outputfile in enumerate(outputfiles):
+      with slurm_rsync_output(outputfile, silentrsync=True, deferred=True) as outputtorsync:
+        with open(outputtorsync, "w") as f: f.write(f"hello {i}")
+    with slurm_rsync_output(self.tmpdir/"notcreated.txt", silentrsync=True, deferred=True, ok_if_not_created=True):
+      pass
+    for outputfile in outputfiles:
+      self.assertFalse(outputfile.exists())
+    slurm_flush_outputs()
+    for i, outputfile in enumerate(outputfiles):
+      with open(outputfile) as f:
+        self.assertEqual(f.read(), f"hello {i}")
+    self.assertFalse((self.tmpdir/"notcreated.txt").exists())
+
+    #outputs that go through rsync are sent in a single call
+    with open(self.tmpdir/"rsync", "w") as f:
+      f.write(f"""#!/bin/bash
+        echo "$@" >> {self.tmpdir/"rsynccalls"}
+        for a in "$@"; do case $a in --files-from=*) list=${{a#--files-from=}};; esac; done
+        src="${{@: -2:1}}"; dest="${{@: -1}}"
+        recursive=false; for a in "$@"; do [ "$a" = -r ] && recursive=true; done
+        while read f; do
+          #like rsync, only copy the contents of directories with -r
+          if [ -d "$src/$f" ]; then
+            if $recursive; then cp -r "$src/$f" "$dest/$(dirname $f)"; else mkdir -p "$dest/$f"; fi
+          else
+            cp "$src/$f" "$dest/$f"
+          fi
+        done < "$list"
+      """)
+    (self.tmpdir/"rsync").chmod(0o777)
+    for i, outputfile in enumerate(outputfiles):
+      with slurm_rsync_output(outputfile, silentrsync=True, deferred=True, copyengine="rsync") as outputtorsync:
+        with open(outputtorsync, "w") as f: f.write(f"hello again {i}")
+    outputdir = self.tmpdir/"outputdir"
+    with slurm_rsync_output(outputdir, silentrsync=True, deferred=True) as outputtorsync:
+      outputtorsync.mkdir()
+      with open(outputtorsync/"inside.txt", "w") as f: f.write("hello from a directory")
+    slurm_flush_outputs()
+    for i, outputfile in enumerate(outputfiles):
+      with open(outputfile) as f:
+        self.assertEqual(f.read(), f"hello again {i}")
+    with open(outputdir/"inside.txt") as f:
+      self.assertEqual(f.read(), "hello from a directory")
+    with open(self.tmpdir/"rsynccalls") as f:
+      self.assertEqual(len(f.readlines()), 1)
+
+    #if rsync fails, the other outputs are still copied, and all the errors are logged
+    with slurm_rsync_output(outputfiles[0], silentrsync=True, deferred=True, copyengine="rsync") as outputtorsync:
+      with open(outputtorsync, "w") as f: f.write("not copied")
+    with slurm_rsync_output(outputfiles[1], silentrsync=True, deferred=True, copyengine="local") as outputtorsync:
+      with open(outputtorsync, "w") as f: f.write("copied")
+    with slurm_rsync_output(outputfiles[2], silentrsync=True, deferred=True) as outputtorsync:
+      with open(outputtorsync, "w") as f: f.write("removed")
+    outputtorsync.unlink()
+    with unittest.mock.patch("job_lock.slurm_tmpdir.subprocess.check_call", side_effect=FileNotFoundError("rsync")), self.assertLogs(logger, logging.ERROR) as logs, self.assertRaises(FileNotFoundError):
+      slurm_flush_outputs()
+    self.assertEqual(len(logs.records), 2)
+    with open(outputfiles[0]) as f:
+      self.assertEqual(f.read(), "hello again 0")
+    with open(outputfiles[1]) as f:
+      self.assertEqual(f.read(), "copied")
+
+    with slurm_rsync_output(outputfiles[0], silentrsync=True, deferred=True) as outputtorsync:
+      with open(outputtorsync, "w") as f: f.write("hello")
+    outputtorsync.unlink()
+    with self.assertRaises(FileNotFoundError):
+      slurm_flush_outputs()
+
+  def testPreemption(self):
+    signals = []
+    def handler(signum, frame):
+      signals.append(signum)
+    self.callback(signal.signal, signal.SIGUSR1, signal.signal(signal.SIGUSR1, handler))
+    self.callback(uninstall_preemption_handler)
+
+    output = self.tmpdir/"output.txt"
+    install_preemption_handler([signal.SIGUSR1])
+    with JobLock(self.tmpdir/"lock1.lock", outputfiles=[output]) as lock1, JobLock(self.tmpdir/"lock2.lock") as lock2:
+      self.assertTrue(lock1)
+      self.assertTrue(lock2)
+      output.touch()
+      os.kill(os.getpid(), signal.SIGUSR1)
+      self.assertEqual(signals, [signal.SIGUSR1])
+      self.assertFalse((self.tmpdir/"lock1.lock").exists())
+      self.assertFalse((self.tmpdir/"lock2.lock").exists())
+      self.assertFalse(output.exists())
+      #the handler is uninstalled after the first signal
+      os.kill(os.getpid(), signal.SIGUSR1)
+      self.assertEqual(signals, [signal.SIGUSR1]*2)
+
+    #send the signal shortly before the time limit
+    os.environ["SLURM_JOB_END_TIME"] = str(time.time() + 10.2)
+    install_preemption_handler([signal.SIGUSR1], graceperiod=datetime.timedelta(seconds=10))
+    with JobLock(self.tmpdir/"lock1.lock") as lock1:
+      self.assertTrue(lock1)
+      for i in range(100):
+        if len(signals) == 3: break
+        time.sleep(0.05)
+      self.assertEqual(signals, [signal.SIGUSR1]*3)
+      self.assertFalse((self.tmpdir/"lock1.lock").exists())
+
   def testSlurmCleanUpTempDir(self):
     filename = self.slurm_tmpdir/"test.txt"
     filename.touch()
@@ -565,6 +1520,82 @@ class TestJobLock(unittest.TestCase, contextlib.ExitStack):
     with JobLock(self.tmpdir/"lock6.lock") as lock6:
       self.assertFalse(lock6)
 
+  def testWatchedSqueueOutput(self):
+    filename = self.tmpdir/"squeueoutput"
+    def publish(output, age=0):
+      with open(self.tmpdir/"newsqueueoutput", "w") as f:
+        f.write(output)
+      os.replace(self.tmpdir/"newsqueueoutput", filename)
+      mtime = time.time() - age
+      os.utime(filename, (mtime, mtime))
+
+    setsqueueoutput(filename=filename, watch=True, maxage=datetime.timedelta(minutes=1))
+    #no file yet, so we don't know
+    self.assertIsNone(jobfinished("SLURM", 0, 1234567, dojoblist=False))
+
+    publish("1234567 RUNNING\n")
+    self.assertFalse(jobfinished("SLURM", 0, 1234567))
+    self.assertTrue(jobfinished("SLURM", 0, 1234566))
+    self.assertIsNone(jobfinished("SLURM", 0, 1234568))
+
+    #the file is read again when it changes
+    publish("1234568 RUNNING\n")
+    self.assertTrue(jobfinished("SLURM", 0, 1234567))
+    self.assertFalse(jobfinished("SLURM", 0, 1234568))
+
+    #and ignored when it's out of date
+    publish("1234568 RUNNING\n", age=120)
+    self.assertIsNone(jobfinished("SLURM", 0, 1234568, dojoblist=False))
+
+    dummysqueue = f"""
+      #!/bin/bash
+      echo "$@" >> {self.tmpdir/"squeueargs"}
+      echo '
+           1234569   RUNNING
+      '
+    """.lstrip()
+    with open(self.tmpdir/"squeue", "w") as f:
+      f.write(dummysqueue)
+    (self.tmpdir/"squeue").chmod(0o777)
+    publish_job_list(filename, interval=0.01, cycles=2)
+    self.assertFalse(jobfinished("SLURM", 0, 1234569))
+    self.assertTrue(jobfinished("SLURM", 0, 1234568))
+    with open(self.tmpdir/"squeueargs") as f:
+      self.assertEqual(f.read(), "--Format jobid,state --noheader\n" * 2)
+    self.assertEqual(sorted(_.name for _ in self.tmpdir.iterdir() if "squeueoutput" in _.name), ["squeueoutput"])
+
+    #from the command line
+    p = argparse.ArgumentParser()
+    add_job_lock_arguments(p)
+    self.assertIn(f"default {BatchSubmissionSystem.defaultjoblistoutputmaxage})", " ".join(p.format_help().split()))
+    process_job_lock_arguments(p.parse_args(["--watch-squeue-output-file", os.fspath(filename), "--job-list-output-max-age", "0:0:0.5"]))
+    self.assertFalse(jobfinished("SLURM", 0, 1234569))
+    publish("1234570 RUNNING\n", age=1)
+    self.assertIsNone(jobfinished("SLURM", 0, 1234569, dojoblist=False))
+
+    #without a max age, the default one is used
+    setsqueueoutput(filename=filename, watch=True)
+    publish("1234570 RUNNING\n", age=120)
+    self.assertFalse(jobfinished("SLURM", 0, 1234570))
+    publish("1234570 RUNNING\n", age=BatchSubmissionSystem.defaultjoblistoutputmaxage.total_seconds() + 60)
+    self.assertIsNone(jobfinished("SLURM", 0, 1234570, dojoblist=False))
+
+  def testlargesqueueoutput(self):
+    njobs = 200000
+    squeueoutput = "".join(f"{jobid} {'PENDING' if jobid % 2 else 'RUNNING'}\n" for jobid in range(1000000, 1000000+njobs))
+    setsqueueoutput(output=squeueoutput)
+    start = time.monotonic()
+    for jobid in range(1000000, 1000000+njobs, njobs//1000):
+      self.assertFalse(jobfinished("SLURM", 0, jobid))
+    #the output is only parsed once, so the lookups are fast
+    self.assertLess(time.monotonic() - start, 1)
+    self.assertTrue(jobfinished("SLURM", 0, 999999))
+    self.assertFalse(jobfinished("SLURM", 0, 1000000+njobs-1))
+    self.assertIsNone(jobfinished("SLURM", 0, 1000000+njobs))
+
+    setsqueueoutput(output="1234567\n")
+    self.assertIsNone(jobfinished("SLURM", 0, 1234567))
+
   def testinvalidsqueue(self):
     dummysqueue = """
       #!/bin/bash
@@ -605,10 +1636,8 @@ class TestJobLock(unittest.TestCase, contextlib.ExitStack):
     goodcondorq = """
       #!/bin/bash
       echo "
-        -- Schedd: my schedd
-         ID      OWNER            SUBMITTED     RUN_TIME ST PRI SIZE CMD
-         1234567.1
-         1234568.1
+         1234567 1 2
+         1234568 1 2
       "
     """.lstrip()
     reallybadcondorq = """
@@ -685,6 +1714,54 @@ class TestJobLock(unittest.TestCase, contextlib.ExitStack):
     with JobLock(self.tmpdir/"lock12.lock") as lock:
       self.assertTrue(lock)
 
+  def testsqueuetimeout(self):
+    dummysqueue = f"""
+      #!/bin/bash
+      echo run >> {self.tmpdir/"squeuecalls"}
+      exec sleep 5
+    """.lstrip()
+    with open(self.tmpdir/"squeue", "w") as f:
+      f.write(dummysqueue)
+    (self.tmpdir/"squeue").chmod(0o777)
+    with open(self.tmpdir/"lock1.lock", "w") as f:
+      f.write("SLURM 0 1234567")
+
+    def nsqueuecalls():
+      with open(self.tmpdir/"squeuecalls") as f:
+        return len(f.read().split())
+
+    BatchSubmissionSystem.setdefaultjoblisttimeout(datetime.timedelta(seconds=0.2))
+    BatchSubmissionSystem.setdefaultjoblistbackoff(datetime.timedelta(seconds=0.5), datetime.timedelta(seconds=1))
+    self.callback(BatchSubmissionSystem.setdefaultjoblisttimeout, BatchSubmissionSystem.defaultjoblisttimeout)
+    self.callback(BatchSubmissionSystem.setdefaultjoblistbackoff, BatchSubmissionSystem.defaultjoblistinitialbackoff, BatchSubmissionSystem.defaultjoblistmaxbackoff)
+
+    start = time.monotonic()
+    with JobLock(self.tmpdir/"lock1.lock") as lock:
+      self.assertFalse(lock)
+    self.assertLess(time.monotonic() - start, 2)
+    self.assertEqual(nsqueuecalls(), 1)
+    with JobLock(self.tmpdir/"lock1.lock") as lock:
+      #the circuit breaker is open, so squeue isn't run
+      self.assertFalse(lock)
+    self.assertEqual(nsqueuecalls(), 1)
+
+    time.sleep(0.5)
+    with JobLock(self.tmpdir/"lock1.lock") as lock:
+      #half open: try once, fail again, back off for longer
+      self.assertFalse(lock)
+    self.assertEqual(nsqueuecalls(), 2)
+    time.sleep(0.5)
+    with JobLock(self.tmpdir/"lock1.lock") as lock:
+      self.assertFalse(lock)
+    self.assertEqual(nsqueuecalls(), 2)
+
+    with open(self.tmpdir/"squeue", "w") as f:
+      f.write("#!/bin/bash\necho\n")
+    time.sleep(0.5)
+    with JobLock(self.tmpdir/"lock1.lock") as lock:
+      #squeue recovered
+      self.assertTrue(lock)
+
   def testArgParse(self):
     p = argparse.ArgumentParser()
     p.add_argument("positional")